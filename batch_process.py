@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: batch_process.py
+"""
+Runs the process on many input files, e.g. one per tenant, on a pool of worker
+processes that stay warm between files: each worker imports SQLAlchemy and the
+models and compiles the patterns once, rather than once per file. Each file gets
+its own database, report and log file (its printed output), as when it is run
+on its own, and the metrics of all the files are aggregated.
+
+Run from command line, passing a directory of input files (*.txt, or compressed
+e.g. *.txt.gz) or a manifest file listing input files one per line, e.g.
+#> python batch_process.py input_files_directory <enter>
+#> python batch_process.py nightly_manifest.lst --processes 4 --metrics-file metrics.txt <enter>
+"""
+
+import codecs
+import glob
+import os, sys
+import time
+
+import run_process
+
+USAGE = """Pass a directory of input files or a manifest listing them, e.g.
+#> python batch_process.py input_files_directory <enter>"""
+INPUT_FILE_PATTERNS = ['*.txt', '*.txt.gz', '*.txt.bz2', '*.txt.xz', '*.txt.zst']
+# files written by the process, which aren't input files even if they are in the directory
+GENERATED_SUFFIXES = ('_output.txt', '_test.txt', '_duplicates.txt', '_log.txt', '_delta.txt')
+METRICS = ['people', 'sims', 'groups', 'seconds']
+
+
+def get_input_files(path):
+    """
+    Returns the input files in a directory (except files written by the process), or
+    listed in a manifest file (one per line, relative to the manifest's directory;
+    blank lines and lines starting with '#' are skipped). Paths are normalized, as output
+    file names are made from the part before the first '.' (e.g. of './input_file.txt').
+    """
+    from compressed_io import strip_compression
+
+    if os.path.isdir(path):
+        names = [name for pattern in INPUT_FILE_PATTERNS for name in glob.glob(os.path.join(path, pattern))]
+        return sorted(os.path.normpath(name) for name in names
+                      if not strip_compression(name).endswith(GENERATED_SUFFIXES) and
+                      '_shard' not in os.path.basename(name))
+    input_files = []
+    with codecs.open(path, mode="r", encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                input_files.append(os.path.normpath(os.path.join(os.path.dirname(path), line)))
+    return input_files
+
+
+def get_log_file_name(input_file):
+    "Returns the name of the log file for an input file."
+    input_file_name = input_file.split('.')[0]  # first part of filename only
+    return '{}_log.txt'.format(input_file_name)
+
+
+def warm_up():
+    "Pays the start-up costs of a worker process once: heavy imports and compiling the patterns."
+    import sqlalchemy
+    import sqlalchemy.orm
+    import models
+    import patterns
+
+    for name in dir(patterns):
+        pattern = getattr(patterns, name)
+        if isinstance(pattern, patterns.LazyPattern):
+            pattern.compile()
+
+
+def process_one(args):
+    """
+    Runs the process on one input file (in a worker process), with its printed output
+    written to its log file. Returns its metrics, with the error message if it failed.
+    """
+    input_file, options = args
+    stdout = sys.stdout
+    with open(get_log_file_name(input_file), 'w') as log_file:
+        sys.stdout = log_file
+        start_time = time.time()
+        try:
+            metrics = run_process.process_file(input_file, **options)
+            metrics['error'] = None
+        except Exception as e:
+            metrics = {'input_file': input_file, 'seconds': time.time() - start_time,
+                       'error': '{}: {}'.format(type(e).__name__, e)}
+            print metrics['error']
+        finally:
+            sys.stdout = stdout
+    return metrics
+
+
+def run_batch(input_files, processes=None, **options):
+    """
+    Runs the process on each input file on a pool of warm worker processes (one per CPU
+    by default). Keyword options are passed to run_process.process_file(). Returns the
+    list of metrics of each file, in the order of input_files.
+    """
+    import multiprocessing
+
+    pool = multiprocessing.Pool(processes, initializer=warm_up)
+    metrics = {}
+    try:
+        jobs = [(input_file, options) for input_file in input_files]
+        for m in pool.imap_unordered(process_one, jobs, chunksize=1):
+            metrics[m['input_file']] = m
+            print '{}: {}'.format(m['input_file'], m['error'] or
+                '{people} people, {sims} sims, {groups} groups in {seconds:.2f} seconds'.format(**m))
+    finally:
+        pool.close()
+        pool.join()
+    return [metrics[input_file] for input_file in input_files]
+
+
+def get_totals(metrics):
+    "Returns a dict of the totals of the metrics of the files that didn't fail."
+    return dict((name, sum(m[name] for m in metrics if not m['error'])) for name in METRICS)
+
+
+def write_metrics(metrics, output_file_name):
+    "Writes the metrics of each file to a tab-delimited file."
+    with codecs.open(output_file_name, mode="w", encoding='utf-8') as outfile:
+        outfile.write(u'\t'.join(['input_file'] + METRICS + ['error']) + u'\n')     # header row
+        for m in metrics:
+            outfile.write(u'\t'.join([m['input_file']] + [unicode(m.get(name, u'')) for name in METRICS] +
+                                     [m['error'] or u'']) + u'\n')
+
+
+def parse_args(argv):
+    "Parses command line arguments. Exits with the usage message if they are incorrect."
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Parse and group people records in many files.', usage=USAGE)
+    parser.add_argument('path', help='directory of input files, or a manifest file listing them')
+    parser.add_argument('--processes', type=int, metavar='P',
+        help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--metrics-file', metavar='FILE', help="write each file's metrics to FILE")
+    parser.add_argument('--memory-budget', type=int, metavar='MB',
+        help='sort each report in at most MB megabytes of memory (see run_process.py)')
+    parser.add_argument('--resume', action='store_true',
+        help="continue each file's interrupted run from its database, e.g. rerunning a failed batch")
+    parser.add_argument('--sims-storage', choices=['table', 'csr'], default='table',
+        help='how each file stores its sims (see run_process.py)')
+    parser.add_argument('--dedup', choices=['hash', 'bloom'], default='hash',
+        help='how each file detects duplicate records (see run_process.py)')
+    parser.add_argument('--engine', choices=['rules', 'tfidf'], default='rules',
+        help='the scoring engine (see run_process.py)')
+    parser.add_argument('--compress', choices=['gz', 'bz2', 'xz', 'zst'],
+        help='compress each report (see run_process.py)')
+    parser.add_argument('--progress-interval', type=float, metavar='SECONDS',
+        help='report the progress of long steps to stderr every SECONDS seconds (see run_process.py)')
+    parser.add_argument('--stable-ids', action='store_true',
+        help="report each group's stable id (see run_process.py)")
+    parser.add_argument('--delta', action='store_true',
+        help="write each file's changes since its previous run (see run_process.py)")
+    parser.add_argument('--max-group-size', type=int, metavar='N',
+        help='split groups of more than N people (see run_process.py)')
+    args = parser.parse_args(argv)
+    run_process.check_compress_arg(parser, '', args.compress)     # input files are checked as each is run
+    return args
+
+
+def main(argv=None):
+    "Command line entry point. Returns a process exit code."
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    input_files = get_input_files(args.path)
+    if not input_files:
+        print 'No input files found in {}.'.format(args.path)
+        return 2
+
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+
+    start_time = time.time()
+    metrics = run_batch(input_files, args.processes, memory_budget=memory_budget, resume=args.resume,
+                        sims_storage=args.sims_storage, dedup=args.dedup, engine=args.engine,
+                        compress=args.compress, progress_interval=args.progress_interval,
+                        stable_ids=args.stable_ids, delta=args.delta, max_group_size=args.max_group_size)
+    wall_time = time.time() - start_time
+    if args.metrics_file:
+        write_metrics(metrics, args.metrics_file)
+
+    totals = get_totals(metrics)
+    failed = [m['input_file'] for m in metrics if m['error']]
+    print '\n{} files ({} failed): {people} people, {sims} sims, {groups} groups.'.format(
+        len(metrics), len(failed), **totals)
+    print 'Processing took {:.2f} seconds in total, in {:.2f} seconds of wall time.'.format(
+        totals['seconds'], wall_time)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: benchmarks.py
+"""
+Benchmarks for the people normalization process. Each benchmark prints its
+measurements and returns True if it stayed within its budget.
+
+Run from command line, passing the name of a benchmark (or 'all'), e.g.
+#> python benchmarks.py startup <enter>
+"""
+
+import os, sys
+import random
+import subprocess
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+STARTUP_BUDGET_MS = 60      # max median wall time to start python and import the entry points
+STARTUP_REPEAT = 10         # number of interpreter launches to take the median of
+HEAVY_MODULES = ['sqlalchemy', 'models']   # must not be imported just by importing an entry point
+
+INSERT_RECORDS = 20000      # people records inserted by the inserts benchmark
+INSERT_MIN_SPEEDUP = 2.0    # bulk insert path must be at least this many times faster than session.add
+
+DEDUP_RECORDS = 200000      # distinct records seen by the dedup benchmark
+DEDUP_MIN_REDUCTION = 10.0  # the hash table must take at least this many times less memory than a dict of records
+
+EMAIL_RECORDS = 50000       # records parsed by the email benchmark
+EMAIL_MIN_SPEEDUP = 1.25    # the single-scan email parser must be at least this many times faster than the regexes
+EMAIL_MANY_AT_TOKENS = 4000 # 'x@y ' tokens in a record with many '@' signs (then 4 times as many)
+EMAIL_MAX_GROWTH = 8.0      # max growth in its parse time for 4x as many tokens (linear is 4x, quadratic 16x)
+
+LINEARITY_LENGTH = 1000     # record length parsed by the linearity benchmark (then 4 times as long)
+LINEARITY_MAX_GROWTH = 8.0  # max growth in parse time for 4x longer records (linear is 4x, quadratic 16x)
+LINEARITY_SEED_RECORDS = 20 # random fuzz records per length, besides the pathological ones
+
+BATCH_FILES = 20            # small input files run by the batch benchmark
+BATCH_RECORDS = 20          # people records per file
+BATCH_MIN_SPEEDUP = 2.0     # one warm batch worker must be at least this many times faster than a process per file
+
+PROGRESS_UPDATES = 1000000  # progress updates timed by the progress benchmark
+PROGRESS_RECORDS = 20000    # records parsed to compare them with
+PROGRESS_MAX_OVERHEAD = 0.05    # max time of a progress update, as a fraction of the time to parse a record
+
+GIANT_PEOPLE = 20000        # people sharing one email (all sims of each other) in the giant benchmark
+GIANT_MAX_GROUP_SIZE = 200  # group size limit they are split to
+
+FIRST_NAMES = [u'robert', u'bob', u'john', u'jon', u'mary', u'maria', u'anne', u'ann',
+               u'jos\xe9', u'william', u'bill', u'katherine', u'catherine', u'li']
+LAST_NAMES = [u'smith', u'smyth', u'nguyen', u'johnson', u'jonson', u"o'brien", u'lee',
+              u'garcia', u'm\xfcller', u'mueller', u'van dyke', u'brown', u'browne']
+DOMAINS = [u'example.com', u'acme.org', u'mail.co.uk', u'corp.net']
+RECORD_FORMATS = [
+    u'"{Last}, {First}" <{first}.{last}@{domain}>',
+    u'"{First} {Last}" <{last}@{domain}>',
+    u'{First} {Last} <{f}{last}@{domain}>',
+    u'{first}.{last}@{domain}',
+    u'{First} {Last} ({first}_{last}@{domain})',
+    u'{first}.q.{last}@{domain}',
+    u'{last}{n}@{domain}',
+    u'{First} {Last}',
+]
+
+
+def median(values):
+    "Returns the median of a list of numbers."
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def make_records(count, seed=0):
+    """
+    Returns a list of (source id, person record) tuples of synthetic people records
+    in the formats commonly found in input files, with many near-duplicates.
+    """
+    rnd = random.Random(seed)
+    records = []
+    for source_id in range(1, count + 1):
+        first, last = rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES)
+        record = rnd.choice(RECORD_FORMATS).format(
+            first=first, First=first.title(), f=first[0],
+            last=last.replace(' ', '').replace("'", ''), Last=last.title(),
+            domain=rnd.choice(DOMAINS), n=rnd.randint(1, 99))
+        records.append((source_id, record))
+    return records
+
+
+def run_python(code, extra_args=()):
+    """
+    Runs a snippet of code in a fresh interpreter from this directory.
+    Returns (wall time in ms, stdout, stderr).
+    """
+    args = [sys.executable] + list(extra_args) + ['-c', code]
+    start = time.time()
+    proc = subprocess.Popen(args, cwd=HERE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    elapsed_ms = (time.time() - start) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError('benchmark subprocess failed:\n{}'.format(err))
+    return elapsed_ms, out, err
+
+
+def get_import_times(module_name):
+    """
+    Returns a list of (cumulative microseconds, module) from python -X importtime
+    for importing a module, slowest first. Returns an empty list on interpreters
+    that don't support -X importtime (it was added in python 3.7).
+    """
+    if sys.version_info < (3, 7):
+        return []
+    _, _, err = run_python('import {}'.format(module_name), ['-X', 'importtime'])
+    import_times = []
+    for line in err.decode('utf-8').splitlines():
+        # format is 'import time: self [us] | cumulative | imported package'
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        import_times.append((int(fields[1]), fields[2].strip()))
+    return sorted(import_times, reverse=True)
+
+
+def bench_startup(repeat=STARTUP_REPEAT, budget_ms=STARTUP_BUDGET_MS):
+    """
+    Measures the start-up time of the command line entry points: launching the
+    interpreter, importing the module, and checking that no heavy module
+    (SQLAlchemy, the ORM models) was imported as a side effect.
+    """
+    ok = True
+    baseline_ms = median([run_python('pass')[0] for _ in range(repeat)])
+    print 'interpreter start-up: {:.1f} ms'.format(baseline_ms)
+    for module_name in ['run_process', 'get_sample_data', 'batch_process']:
+        code = 'import sys, {}; print(",".join(m for m in {!r} if m in sys.modules))'.format(
+            module_name, HEAVY_MODULES)
+        timings = []
+        for _ in range(repeat):
+            elapsed_ms, out, _ = run_python(code)
+            timings.append(elapsed_ms)
+        heavy = out.decode('utf-8').strip()
+        startup_ms = median(timings)
+        within_budget = startup_ms <= budget_ms and not heavy
+        ok = ok and within_budget
+        print '{}: {:.1f} ms (+{:.1f} ms imports), budget {} ms{}{}'.format(
+            module_name, startup_ms, startup_ms - baseline_ms, budget_ms,
+            ', heavy modules imported: {}'.format(heavy) if heavy else '',
+            '' if within_budget else '  ** OVER BUDGET **')
+        for cumulative_us, name in get_import_times(module_name)[:5]:
+            print '    {:>8} us  {}'.format(cumulative_us, name)
+    return ok
+
+
+def bench_inserts(count=INSERT_RECORDS, min_speedup=INSERT_MIN_SPEEDUP):
+    """
+    Compares inserts per second of people records through the ORM (a Person object
+    per record and a session.add loop) and through the bulk path used by step 1
+    (parse_person rows and a Core executemany), into an in-memory database.
+    """
+    import sqlalchemy
+    import sqlalchemy.orm
+    import models
+    from person_parse import parse_person
+    import run_process
+
+    # unique records, as step 1 skips duplicates
+    records = [(source_id, u'{} {}'.format(record, source_id)) for source_id, record in make_records(count)]
+
+    def new_session():
+        engine = sqlalchemy.create_engine('sqlite://')
+        models.Base.metadata.create_all(engine)
+        return sqlalchemy.orm.sessionmaker(bind=engine)()
+
+    session = new_session()
+    start = time.time()
+    for source_id, record in records:
+        session.add(models.Person(source_id, record))
+    session.commit()
+    orm_rate = count / (time.time() - start)
+
+    session = new_session()
+    insert_person = models.Person.__table__.insert()
+    start = time.time()
+    for i in range(0, count, run_process.INSERT_BATCH_SIZE):
+        session.execute(insert_person, [parse_person(source_id, record)
+                        for source_id, record in records[i:i + run_process.INSERT_BATCH_SIZE]])
+    session.commit()
+    bulk_rate = count / (time.time() - start)
+
+    speedup = bulk_rate / orm_rate
+    print 'session.add loop: {:.0f} inserts/s'.format(orm_rate)
+    print 'bulk insert:      {:.0f} inserts/s ({:.1f}x, minimum {}x){}'.format(
+        bulk_rate, speedup, min_speedup, '' if speedup >= min_speedup else '  ** TOO SLOW **')
+    return speedup >= min_speedup
+
+
+def bench_dedup(count=DEDUP_RECORDS, min_reduction=DEDUP_MIN_REDUCTION):
+    """
+    Compares the memory used to detect duplicates among records: a dict of the record
+    strings (as step 1 used to keep), the hash table of dedup.py and its Bloom filter.
+    """
+    from dedup import Deduplicator
+
+    records = [u'{} {}'.format(record, source_id) for source_id, record in make_records(count)]
+    records_processed = dict((record, 1) for record in records)
+    dict_size = sys.getsizeof(records_processed) + sum(sys.getsizeof(record) for record in records)
+
+    sizes = []
+    for deduplicator in [Deduplicator(), Deduplicator(lambda record: True, bloom_capacity=count)]:
+        start = time.time()
+        for record in records:
+            deduplicator.is_duplicate(record)
+        sizes.append((deduplicator.get_size_bytes(), time.time() - start))
+
+    (hash_size, hash_time), (bloom_size, bloom_time) = sizes
+    reduction = float(dict_size) / hash_size
+    print 'dict of records: {:.1f} bytes/record'.format(float(dict_size) / count)
+    print 'hash table:      {:.1f} bytes/record ({:.1f}x less, minimum {}x), {:.0f} records/s{}'.format(
+        float(hash_size) / count, reduction, min_reduction, count / hash_time,
+        '' if reduction >= min_reduction else '  ** TOO BIG **')
+    print 'Bloom filter:    {:.1f} bytes/record ({:.1f}x less), {:.0f} records/s'.format(
+        float(bloom_size) / count, float(dict_size) / bloom_size, count / bloom_time)
+    return reduction >= min_reduction
+
+
+def bench_email(count=EMAIL_RECORDS, min_speedup=EMAIL_MIN_SPEEDUP, tokens=EMAIL_MANY_AT_TOKENS,
+                max_growth=EMAIL_MAX_GROWTH):
+    """
+    Compares records per second parsed by get_email_name_domain (a single scan) and the
+    reference version with three regexes, and checks that their results are the same.
+    Then checks that the scan stays linear on records with many '@' signs.
+    """
+    from person_parse import get_email_name_domain, get_email_name_domain_regex
+
+    records = [record for _, record in make_records(count)]
+    rates, results = [], []
+    for parse in [get_email_name_domain_regex, get_email_name_domain]:
+        start = time.time()
+        results.append([parse(record) for record in records])
+        rates.append(count / (time.time() - start))
+
+    (regex_rate, scan_rate), same = rates, results[0] == results[1]
+    speedup = scan_rate / regex_rate
+    print 'three regexes: {:.0f} records/s'.format(regex_rate)
+    print 'single scan:   {:.0f} records/s ({:.1f}x, minimum {}x){}{}'.format(
+        scan_rate, speedup, min_speedup, '' if speedup >= min_speedup else '  ** TOO SLOW **',
+        '' if same else '  ** DIFFERENT RESULTS **')
+
+    times = []
+    for record in [u'x@y ' * tokens, u'x@y ' * (4 * tokens)]:
+        start = time.time()
+        result = get_email_name_domain(record)
+        times.append(time.time() - start)
+        same = same and result == get_email_name_domain_regex(record)
+    growth = times[1] / max(times[0], 1e-9)
+    print "many '@' signs: {:.1f} ms for {:,} tokens, {:.1f} ms for {:,} ({:.1f}x, maximum {}x){}{}".format(
+        times[0] * 1000, tokens, times[1] * 1000, 4 * tokens, growth, max_growth,
+        '' if growth <= max_growth else '  ** NOT LINEAR **', '' if same else '  ** DIFFERENT RESULTS **')
+    return speedup >= min_speedup and growth <= max_growth and same
+
+
+# pathological records for name parsing: whitespace-heavy text, long words and pasted garbage
+PATHOLOGICAL_RECORDS = [
+    ('spaces', u' '),
+    ('words and spaces', u'a '),
+    ('words and double spaces', u'ab  '),
+    ('long word', u'a'),
+    ('dotted words', u'a.'),
+    ('words before @', u'ab.cd-ef '),
+    ('comma list', u'a-b, '),
+    ('html', u'<div class="x"> a b </div> '),
+    ('signature', u'John Smith  Director, Sales  ACME Inc.  '),
+]
+
+
+def make_fuzz_record(length, rng):
+    "Returns a random record of a length, from the characters the name patterns care about."
+    return u''.join(rng.choice(u'ab  \t<(),@._-"\'') for _ in range(length))
+
+
+def bench_linearity(length=LINEARITY_LENGTH, max_growth=LINEARITY_MAX_GROWTH):
+    """
+    Measures how the time to parse names grows from records of a length to records 4 times
+    as long (without the length cap), for pathological and random fuzz records. It must
+    grow linearly; patterns that backtrack super-linearly grow 16 times or more.
+    """
+    from person_parse import get_firstname_lastname
+
+    def parse_time(records):
+        "Returns the best of 5 times to parse the records."
+        times = []
+        for _ in range(5):
+            start = time.time()
+            for record in records:
+                get_firstname_lastname(record, max_length=None)
+            times.append(time.time() - start)
+        return min(times)
+
+    def repeat(unit, n, suffix):
+        "Returns a record of n characters: unit repeated, then a suffix."
+        return (unit * (n // len(unit) + 1))[:n - len(suffix)] + suffix
+
+    # each pathological record as is, before an email name and before an email address
+    cases = [(name, lambda n, unit=unit: [repeat(unit, n, suffix) for suffix in (u'', u'x@', u' x<')])
+             for name, unit in PATHOLOGICAL_RECORDS]
+    cases.append(('random fuzz', lambda n: [make_fuzz_record(n, random.Random(i))
+                                            for i in range(LINEARITY_SEED_RECORDS)]))
+    ok = True
+    for name, make in cases:
+        short_time, long_time = parse_time(make(length)), parse_time(make(length * 4))
+        growth = long_time / short_time if short_time > 0 else 0
+        ok = ok and growth <= max_growth
+        print '{:<24} {:8.2f} ms at {} chars, {:8.2f} ms at {} ({:.1f}x, maximum {}x){}'.format(
+            name, short_time * 1000, length, long_time * 1000, length * 4, growth, max_growth,
+            '' if growth <= max_growth else '  ** SUPER-LINEAR **')
+    return ok
+
+
+def bench_batch(count_files=BATCH_FILES, count_records=BATCH_RECORDS, min_speedup=BATCH_MIN_SPEEDUP):
+    """
+    Compares the wall time to process many small input files with a python process
+    per file (run_process.py) and with one warm worker of batch_process.py.
+    """
+    import codecs
+    import glob
+    import shutil
+    import tempfile
+    import run_process
+
+    directory = tempfile.mkdtemp()
+    try:
+        records = make_records(count_files * count_records)
+        for i in range(count_files):
+            with codecs.open(os.path.join(directory, 'input{}.txt'.format(i)), 'w', run_process.ENCODING) as f:
+                f.write(u'person_id{}person\n'.format(run_process.DELIMETER))
+                for source_id, record in records[i * count_records:(i + 1) * count_records]:
+                    f.write(u'{}{}{}\n'.format(source_id, run_process.DELIMETER, record))
+        input_files = sorted(glob.glob(os.path.join(directory, '*.txt')))
+
+        def run(args):
+            start = time.time()
+            subprocess.check_call([sys.executable] + args, cwd=directory, stdout=open(os.devnull, 'w'))
+            return time.time() - start
+
+        process_time = sum(run([os.path.join(HERE, 'run_process.py'), name]) for name in input_files)
+        for name in glob.glob(os.path.join(directory, '*.sqlite')):
+            os.remove(name)     # so that the batch starts from scratch too
+        batch_time = run([os.path.join(HERE, 'batch_process.py'), directory, '--processes', '1'])
+    finally:
+        shutil.rmtree(directory)
+
+    speedup = process_time / batch_time
+    print 'process per file: {:.2f} s for {} files of {} records'.format(process_time, count_files, count_records)
+    print 'batch:            {:.2f} s ({:.1f}x, minimum {}x){}'.format(
+        batch_time, speedup, min_speedup, '' if speedup >= min_speedup else '  ** TOO SLOW **')
+    return speedup >= min_speedup
+
+
+def bench_progress(count=PROGRESS_UPDATES, max_overhead=PROGRESS_MAX_OVERHEAD):
+    """
+    Measures the overhead of progress reporting in the loops of the steps: the time of
+    a progress update, compared with the time to parse a record (in step 1).
+    """
+    import progress
+    from person_parse import parse_person
+
+    progress.configure(interval=progress.PROGRESS_INTERVAL)
+    p = progress.Progress('benchmark', 'updates', count)
+    start = time.time()
+    for _ in xrange(count):
+        pass
+    loop_time = time.time() - start
+    start = time.time()
+    for _ in xrange(count):
+        p.update()
+    update_ns = (time.time() - start - loop_time) / count * 1e9
+
+    records = make_records(PROGRESS_RECORDS)
+    start = time.time()
+    for source_id, record in records:
+        parse_person(source_id, record)
+    record_ns = (time.time() - start) / len(records) * 1e9
+
+    overhead = update_ns / record_ns
+    print 'progress update: {:.0f} ns'.format(update_ns)
+    print 'parse a record:  {:.0f} ns (update is {:.1%}, maximum {:.0%}){}'.format(
+        record_ns, overhead, max_overhead, '' if overhead <= max_overhead else '  ** TOO SLOW **')
+    return overhead <= max_overhead
+
+
+def bench_giant(count=GIANT_PEOPLE, max_group_size=GIANT_MAX_GROUP_SIZE):
+    """
+    Groups a pathological clique (people who all share an email) kept as a compact sims
+    graph, without and with a group size limit. Checks that no group is larger than the
+    limit, which bounds what a reviewer is shown.
+    """
+    from collections import Counter
+    from grouping import assign_groups
+    from sim_graph import SimGraph
+
+    rnd = random.Random(0)
+    person_ids = range(1, count + 1)
+    graph = SimGraph.from_lists([person_ids], [[0]])
+    names = dict((person_id, (rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES))) for person_id in person_ids)
+    get_scores = lambda person_id, other_ids: [100] * len(other_ids)    # identical emails
+
+    ok = True
+    for limit in [None, max_group_size]:
+        split_people = []
+        start = time.time()
+        group_of, groups = assign_groups(person_ids, graph.get_similar, names, max_group_size=limit,
+                                         get_scores=get_scores, split_people=split_people)
+        seconds = time.time() - start
+        largest = max(Counter(group_of.values()).values())
+        too_large = limit and largest > limit
+        ok = ok and not too_large
+        print '{:,} people, limit {}: {} groups, largest {:,}, {} people split from groups, {:.2f} seconds{}'.format(
+            count, limit or 'none', len(groups), largest, len(split_people), seconds,
+            '  ** TOO LARGE **' if too_large else '')
+    return ok
+
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'inserts': bench_inserts,
+    'dedup': bench_dedup,
+    'email': bench_email,
+    'linearity': bench_linearity,
+    'batch': bench_batch,
+    'progress': bench_progress,
+    'giant': bench_giant,
+}
+
+
+def main(argv=None):
+    "Command line entry point. Returns a process exit code."
+    if argv is None:
+        argv = sys.argv[1:]
+    names = argv or ['all']
+    if names == ['all']:
+        names = sorted(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print 'Unknown benchmark(s): {}. Choose from: all, {}'.format(
+            ', '.join(unknown), ', '.join(sorted(BENCHMARKS)))
+        return 2
+    ok = True
+    for name in names:
+        print '** {} **'.format(name)
+        ok = BENCHMARKS[name]() and ok
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: blocking.py
+"""
+Plans the candidate pairs scored in step 2 by blocking: people are only scored
+against people who share a blocking key, instead of against everyone.
+
+Each BlockingPass describes one way two people can reach a score, and the key
+they must share to do so (e.g. identical emails score 100, so people only need
+to be compared within blocks of the same email). The planner inspects the
+distribution of the keys, and splits oversized blocks with secondary keys. A
+secondary key is lossless if people who differ on it can't score at or above
+the threshold. Only lossless keys are used unless an approximate block size
+cap is given, so by default the pairs scored at or above the threshold are
+exactly the same as when comparing every pair of people.
+
+The passes must be kept in step with get_sim_score() in person_parse.py.
+"""
+
+from collections import defaultdict
+from person_parse import get_deletion_variants, get_signature
+
+MAX_BLOCK_SIZE = 1000       # blocks with more people than this are split with secondary keys
+
+
+class SecondaryKey(object):
+    """
+    A key used to split an oversized block. max_lost_score is the highest score
+    that two people in the block who differ on this key can have, so splitting
+    is lossless when the score threshold is above it. A multi-valued key returns
+    a list of keys, and puts a person in the sub-block of each.
+    """
+    def __init__(self, name, key, max_lost_score, multi_valued=False):
+        self.name = name
+        self.key = key
+        self.max_lost_score = max_lost_score
+        self.multi_valued = multi_valued
+
+    def keys(self, person):
+        "Returns the list of keys for a person."
+        return self.key(person) if self.multi_valued else [self.key(person)]
+
+    def is_lossless(self, score_threshold):
+        return score_threshold > self.max_lost_score
+
+
+class BlockingPass(object):
+    """
+    One way two people can score in get_sim_score(): the key they must share,
+    which returns None for people who can't score this way, and the secondary
+    keys that can be used to split oversized blocks.
+    """
+    def __init__(self, name, key, secondary_keys=()):
+        self.name = name
+        self.key = key
+        self.secondary_keys = list(secondary_keys)
+
+
+BLOCKING_PASSES = [
+    # identical (non-blank) emails --> 100
+    BlockingPass('email', lambda p: p.email or None),
+    # (non-blank) last names that sound the same --> 80 with identical first names, 70 with
+    # nicknames of the same first name, 65 with a typo in the first name, 60 if the last names
+    # are spelled differently, otherwise 10 or 0. Last names with no letters have no phonetic
+    # key, so they're blocked as spelled.
+    BlockingPass('last_name_key', lambda p: (p.last_name_key, '' if p.last_name_key else p.last_name)
+                 if p.last_name else None, [
+        # identical, nickname and mistyped first names share the canonical name or a deletion variant
+        SecondaryKey('first_name_variants',
+                     lambda p: list(get_deletion_variants(p.first_name)) + [p.first_name_key], 10, True),
+        SecondaryKey('first_name_key', lambda p: p.first_name_key, 65),
+        SecondaryKey('last_name', lambda p: p.last_name, 60),
+        SecondaryKey('first_initial', lambda p: p.first_name[:1], 70),
+        SecondaryKey('domain', lambda p: p.domain, 80),
+    ]),
+]
+
+# keys whose distribution is reported by the planner, as (name, function returning a list of keys)
+INSPECTED_KEYS = [
+    ('last_name', lambda p: [p.last_name] if p.last_name else []),
+    ('last_name_key', lambda p: [p.last_name_key] if p.last_name_key else []),
+    ('email', lambda p: [p.email] if p.email else []),
+    ('domain', lambda p: [p.domain] if p.domain else []),
+    ('n_gram', lambda p: [g for g in p.n_grams.split(',') if g] if p.n_grams else []),
+]
+
+
+def group_by_signature(people):
+    """
+    Collapses people into lists of people with the same signature (the attributes
+    get_sim_score reads), in order of their first person. Only one person from each
+    list (the first) needs to be scored.
+    """
+    signatures = {}
+    for person in people:
+        signatures.setdefault(get_signature(person), []).append(person)
+    return sorted(signatures.values(), key=lambda members: members[0].id)
+
+
+def count_comparisons(block_sizes):
+    "Returns the number of (directed) comparisons needed to score every pair within each block."
+    return sum(k * (k - 1) for k in block_sizes)
+
+
+def group_by_key(people, keys):
+    """
+    Returns a list of blocks (lists of people) sharing the same key, for a function
+    returning a list of keys for a person. Keys that are None are dropped.
+    """
+    blocks = defaultdict(list)
+    for person in people:
+        for k in set(keys(person)):
+            if k is not None:
+                blocks[k].append(person)
+    return blocks.values()
+
+
+def get_key_stats(people, keys):
+    "Returns (number of blocks, largest block size, comparisons) for a function returning a list of keys."
+    block_sizes = defaultdict(int)
+    for person in people:
+        for k in keys(person):
+            block_sizes[k] += 1
+    sizes = block_sizes.values()
+    return len(sizes), max(sizes) if sizes else 0, count_comparisons(sizes)
+
+
+def split_block(block, secondary_keys, max_block_size):
+    """
+    Splits a block larger than max_block_size using the secondary key that leaves the
+    fewest comparisons, then splits the resulting blocks with the remaining keys.
+    Returns a list of blocks.
+    """
+    if len(block) <= max_block_size or not secondary_keys:
+        return [block]
+    splits = [(count_comparisons(len(b) for b in group_by_key(block, k.keys)), i)
+              for i, k in enumerate(secondary_keys)]
+    _, best = min(splits)
+    key = secondary_keys[best]
+    remaining = secondary_keys[:best] + secondary_keys[best + 1:]
+    blocks = []
+    for sub_block in group_by_key(block, key.keys):
+        blocks.extend(split_block(sub_block, remaining, max_block_size))
+    return blocks
+
+
+def cap_block(block, block_size_cap):
+    "Splits a block into chunks of at most block_size_cap people (in id order). This is lossy."
+    block = sorted(block, key=lambda p: p.id)
+    return [block[i:i + block_size_cap] for i in range(0, len(block), block_size_cap)]
+
+
+class BlockingPlan(object):
+    """
+    The blocks of people to be scored against each other in step 2, and
+    the lines of a report on how they were planned.
+    """
+    def __init__(self):
+        self.blocks = []
+        self.person_blocks = defaultdict(list)   # person id --> the blocks containing that person
+        self.report = []
+
+    def add_block(self, block):
+        if len(block) < 2:
+            return      # a person alone in a block has nothing to be compared to
+        self.blocks.append(block)
+        for person in block:
+            self.person_blocks[person.id].append(block)
+
+    def get_candidates(self, person):
+        "Returns the people sharing a block with a person (excluding the person), in id order."
+        candidates = {}
+        for block in self.person_blocks.get(person.id, ()):
+            for b_person in block:
+                candidates[b_person.id] = b_person
+        candidates.pop(person.id, None)
+        return [candidates[i] for i in sorted(candidates)]
+
+    def count_comparisons(self):
+        "Returns an upper bound on the comparisons (people in two blocks are compared once)."
+        return count_comparisons(len(block) for block in self.blocks)
+
+
+def plan_blocks(people, score_threshold, max_block_size=MAX_BLOCK_SIZE, block_size_cap=None):
+    """
+    Returns a BlockingPlan for a list of people (objects or rows with the Person attributes).
+    Blocks larger than max_block_size are split with the lossless secondary keys. If
+    block_size_cap is given, blocks still larger than the cap are also split with lossy
+    secondary keys and then into chunks, which approximates the exhaustive result.
+    """
+    plan = BlockingPlan()
+    n = len(people)
+    plan.report.append('{} people; {} comparisons without blocking.'.format(n, n * (n - 1)))
+    for name, keys in INSPECTED_KEYS:
+        plan.report.append('  key {}: {} blocks, largest {}, {} comparisons'.format(
+            name, *get_key_stats(people, keys)))
+
+    for blocking_pass in BLOCKING_PASSES:
+        lossless = [k for k in blocking_pass.secondary_keys if k.is_lossless(score_threshold)]
+        lossy = [k for k in blocking_pass.secondary_keys if not k.is_lossless(score_threshold)]
+        count_blocks, count_split, count_capped = 0, 0, 0
+        for block in group_by_key(people, lambda p: [blocking_pass.key(p)]):
+            sub_blocks = split_block(block, lossless, max_block_size)
+            count_split += len(sub_blocks) > 1
+            if block_size_cap:
+                capped = []
+                for sub_block in sub_blocks:
+                    if len(sub_block) > block_size_cap:
+                        count_capped += 1
+                        for lossy_block in split_block(sub_block, lossy, block_size_cap):
+                            capped.extend(cap_block(lossy_block, block_size_cap))
+                    else:
+                        capped.append(sub_block)
+                sub_blocks = capped
+            for sub_block in sub_blocks:
+                plan.add_block(sub_block)
+            count_blocks += 1
+        plan.report.append('  pass {}: {} blocks, {} split with secondary keys ({}), {} capped'.format(
+            blocking_pass.name, count_blocks, count_split,
+            ', '.join(k.name for k in lossless) or 'none lossless', count_capped))
+
+    plan.report.append('Expected comparisons: at most {}{}.'.format(
+        plan.count_comparisons(), ' (approximate: blocks capped at {})'.format(block_size_cap)
+        if block_size_cap else ''))
+    return plan
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: compressed_io.py
+"""
+Opens text files that may be compressed, by their extension: .gz (gzip), .bz2,
+.xz (needs the lzma module, or backports.lzma on python 2) or .zst (needs the
+zstandard package). Files are (de)compressed as a stream, so a compressed input
+never has to be decompressed to disk, and reads and writes go through large
+buffers rather than a call to the decompressor per line.
+
+open_text() is a drop-in for codecs.open() for reading or writing whole files.
+"""
+
+import codecs
+import io
+
+BUFFER_SIZE = 1024 * 1024   # bytes read from or written to the (de)compressor at a time
+COMPRESSIONS = ['gz', 'bz2', 'xz', 'zst']
+
+
+def get_compression(file_name):
+    "Returns the compression of a file by its extension ('gz', 'bz2', 'xz' or 'zst'), or None."
+    extension = file_name.rsplit('.', 1)[-1].lower()
+    return extension if extension in COMPRESSIONS else None
+
+
+def strip_compression(file_name):
+    "Returns a file name without its compression extension, e.g. 'input.txt' for 'input.txt.gz'."
+    return file_name.rsplit('.', 1)[0] if get_compression(file_name) else file_name
+
+
+def add_compression(file_name, compression=None):
+    "Returns a file name with the extension of a compression added, e.g. 'output.txt.gz'."
+    return '{}.{}'.format(file_name, compression) if compression else file_name
+
+
+class RawStream(io.RawIOBase):
+    """
+    Adapts a file-like object with read() or write(), e.g. a bz2.BZ2File, to the raw
+    stream interface, so it can be wrapped in an io.BufferedReader or BufferedWriter.
+    Closing it closes the file-like object, then any others it was opened on.
+    """
+    def __init__(self, stream, mode, others=()):
+        self.stream = stream
+        self.mode = mode
+        self.others = others
+
+    def readable(self):
+        return self.mode == 'r'
+
+    def writable(self):
+        return self.mode == 'w'
+
+    def readinto(self, b):
+        data = self.stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def write(self, b):
+        self.stream.write(memoryview(b).tobytes())
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+            for other in self.others:
+                other.close()
+        io.RawIOBase.close(self)
+
+
+def get_codec(compression):
+    """
+    Returns the module that (de)compresses a compression. Raises ImportError with what
+    to install if it isn't installed, so callers can check before doing any work.
+    """
+    if compression == 'gz':
+        import gzip
+        return gzip
+    elif compression == 'bz2':
+        import bz2
+        return bz2
+    elif compression == 'xz':
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise ImportError('Reading or writing .xz files needs the lzma module (backports.lzma on python 2).')
+        return lzma
+    elif compression == 'zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('Reading or writing .zst files needs the zstandard package.')
+        return zstandard
+    raise ValueError('Unknown compression: {}'.format(compression))
+
+
+def open_compressed(file_name, mode, compression):
+    "Returns a RawStream (de)compressing a file with mode 'r' or 'w'."
+    codec = get_codec(compression)
+    if compression == 'gz':
+        return RawStream(codec.GzipFile(file_name, mode + 'b'), mode)
+    elif compression == 'bz2':
+        return RawStream(codec.BZ2File(file_name, mode), mode)
+    elif compression == 'xz':
+        return RawStream(codec.LZMAFile(file_name, mode + 'b'), mode)
+    f = io.open(file_name, mode + 'b')     # zst
+    if mode == 'r':
+        return RawStream(codec.ZstdDecompressor().stream_reader(f), mode, [f])
+    return RawStream(codec.ZstdCompressor().stream_writer(f), mode, [f])
+
+
+def open_binary(file_name, mode='r'):
+    "Returns a buffered binary stream of a file, (de)compressed as its extension says. mode is 'r' or 'w'."
+    compression = get_compression(file_name)
+    if not compression:
+        return io.open(file_name, mode + 'b', buffering=BUFFER_SIZE)
+    raw = open_compressed(file_name, mode, compression)
+    if mode == 'r':
+        return io.BufferedReader(raw, BUFFER_SIZE)
+    return io.BufferedWriter(raw, BUFFER_SIZE)
+
+
+def open_text(file_name, mode='r', encoding='utf-8'):
+    """
+    Returns a stream reading or writing unicode text in a file, (de)compressed as its
+    extension says. Like codecs.open(), lines end only where the file says so (there
+    is no newline translation).
+    """
+    if mode == 'r':
+        return codecs.getreader(encoding)(open_binary(file_name, mode))
+    return codecs.getwriter(encoding)(open_binary(file_name, mode))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: dedup.py
+"""
+Detects duplicate records in a stream without keeping the records themselves.
+
+By default each record is reduced to a 64-bit hash, kept in a compact open
+addressing hash table (8 bytes per slot instead of a dict entry plus the record
+string, on every platform: a C long is only 32 bits on Windows, so each hash is
+kept as two 32-bit halves). Optionally a Bloom filter (about 10 bits per record) is used instead,
+in front of an exact check that the caller provides, e.g. a lookup on the
+unique input_record index. The exact check is only made for records the filter
+has (probably) seen, and in hash mode it also guards against hash collisions.
+
+Only the records that do turn out to be duplicated are kept, with their counts.
+"""
+
+from array import array
+import codecs
+import hashlib
+import math
+import struct
+
+HASH_TABLE_MIN_SIZE = 1024  # initial number of slots in the hash table (a power of 2)
+HASH_TABLE_MAX_LOAD = 0.6   # the table doubles when more than this fraction of its slots are used
+BLOOM_ERROR_RATE = 0.01     # target false positive rate of the Bloom filter, at its capacity
+EMPTY = 0                   # marks an empty slot (hashes of 0 are stored as 1)
+
+
+def get_record_hash(record):
+    "Returns a 64-bit (signed) hash of a record, that is never EMPTY."
+    digest = hashlib.md5(record.encode('utf-8')).digest()
+    return struct.unpack('<q', digest[:8])[0] or 1
+
+
+class HashSet(object):
+    """
+    A set of 64-bit hashes, in an open addressing (linear probing) table kept as two
+    arrays of unsigned 32-bit ints: the low and the high halves of the hashes.
+    """
+    def __init__(self, size=HASH_TABLE_MIN_SIZE):
+        self.low = array('I', [EMPTY]) * size
+        self.high = array('I', [EMPTY]) * size
+        self.mask = size - 1
+        self.count = 0
+
+    def add(self, h):
+        "Adds a hash. Returns False if it was already in the set."
+        low, high = self.low, self.high
+        h_low, h_high = h & 0xffffffff, (h >> 32) & 0xffffffff
+        i = h_low & self.mask
+        while low[i] != EMPTY or high[i] != EMPTY:
+            if low[i] == h_low and high[i] == h_high:
+                return False
+            i = (i + 1) & self.mask
+        low[i], high[i] = h_low, h_high
+        self.count += 1
+        if self.count > HASH_TABLE_MAX_LOAD * len(low):
+            self.grow()
+        return True
+
+    def grow(self):
+        old_low, old_high = self.low, self.high
+        self.low = array('I', [EMPTY]) * (len(old_low) * 2)
+        self.high = array('I', [EMPTY]) * (len(old_low) * 2)
+        self.mask = len(self.low) - 1
+        for h_low, h_high in zip(old_low, old_high):
+            if h_low != EMPTY or h_high != EMPTY:
+                i = h_low & self.mask
+                while self.low[i] != EMPTY or self.high[i] != EMPTY:
+                    i = (i + 1) & self.mask
+                self.low[i], self.high[i] = h_low, h_high
+
+    def get_size_bytes(self):
+        return (self.low.itemsize + self.high.itemsize) * len(self.low)
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter sized for capacity hashes at error_rate false positives. Past its
+    capacity it still works, with a rising false positive rate.
+    """
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        bits = int(-capacity * math.log(error_rate) / math.log(2) ** 2) or 8
+        self.bits = bytearray((bits + 7) // 8)
+        self.count_bits = len(self.bits) * 8
+        self.count_hashes = max(1, int(round(float(self.count_bits) / capacity * math.log(2))))
+
+    def get_bits(self, h):
+        "Returns the bit numbers for a hash (double hashing on its two 32-bit halves)."
+        h1, h2 = h & 0xffffffff, (h >> 32) & 0xffffffff | 1
+        return [(h1 + i * h2) % self.count_bits for i in range(self.count_hashes)]
+
+    def add(self, h):
+        "Adds a hash. Returns False if it was (probably) already added."
+        is_new = False
+        for bit in self.get_bits(h):
+            if not self.bits[bit >> 3] & (1 << (bit & 7)):
+                self.bits[bit >> 3] |= 1 << (bit & 7)
+                is_new = True
+        return is_new
+
+    def get_size_bytes(self):
+        return len(self.bits)
+
+
+class Deduplicator(object):
+    """
+    Tells whether each record has been seen before, and counts the duplicated ones.
+    exact_check(record) returns True if a record has really been seen before; it is
+    called only when the hash table or Bloom filter says it may have been, and is
+    required with a Bloom filter. Give bloom_capacity (the expected number of
+    distinct records) to use a Bloom filter instead of the hash table.
+    """
+    def __init__(self, exact_check=None, bloom_capacity=None, error_rate=BLOOM_ERROR_RATE):
+        if bloom_capacity and exact_check is None:
+            raise ValueError('A Bloom filter needs an exact check for the records it may have seen.')
+        self.exact_check = exact_check
+        self.seen = BloomFilter(bloom_capacity, error_rate) if bloom_capacity else HashSet()
+        self.duplicates = {}    # duplicated record --> number of times seen
+        self.count = 0
+        self.count_duplicates = 0
+        self.count_exact_checks = 0
+
+    def is_duplicate(self, record):
+        "Returns True if the record has been seen before. Otherwise it is now."
+        self.count += 1
+        if self.seen.add(get_record_hash(record)):
+            return False
+        if self.exact_check is not None:
+            self.count_exact_checks += 1
+            if not self.exact_check(record):
+                return False    # a hash collision or a Bloom filter false positive
+        self.count_duplicates += 1
+        self.duplicates[record] = self.duplicates.get(record, 1) + 1
+        return True
+
+    def get_size_bytes(self):
+        "Returns the size in bytes of the hash table or Bloom filter."
+        return self.seen.get_size_bytes()
+
+
+def get_duplicates_file_name(input_file):
+    "Returns the name of the duplicate counts file for an input file."
+    input_file_name = input_file.split('.')[0]  # first part of filename only
+    return '{}_duplicates.txt'.format(input_file_name)
+
+
+def write_duplicates(deduplicator, output_file_name, encoding, delimiter=u'\t'):
+    "Writes the duplicated records and their counts to a tab-delimited file, most duplicated first."
+    with codecs.open(output_file_name, mode="w", encoding=encoding) as outfile:
+        outfile.write(u'count{}input_record\n'.format(delimiter))     # header row
+        for record, count in sorted(deduplicator.duplicates.items(), key=lambda item: (-item[1], item[0])):
+            outfile.write(u'{}{}{}\n'.format(count, delimiter, record))
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: delta.py
+"""
+Compares the people of a run with those of the previous run of the same input,
+so that only the changes need to be loaded downstream.
+
+People are matched by source_person_id, and groups compared by their stable ids
+(see grouping.get_stable_id), which unlike sim_group ids don't depend on the
+order groups were created in. Both databases are read in source_person_id order
+and merged, so neither is held in memory, only a dict of group id --> stable id.
+A person is in the delta if they were added or removed, or if their group,
+names, email or domain changed.
+"""
+
+DELTA_COLUMNS = ['change', 'person_id', 'input_record', 'sim_group_id', 'first_name', 'last_name',
+                 'email', 'domain', 'previous_sim_group_id']
+
+
+def get_previous_db_name(input_file):
+    "Returns the name the database of the previous run is kept under."
+    input_file_name = input_file.split('.')[0]  # first part of filename only
+    return '{}_previous.sqlite'.format(input_file_name)
+
+
+def get_delta_file_name(input_file, compress=None):
+    "Returns the name of the delta report file for an input file (compressed like the report)."
+    from compressed_io import add_compression
+
+    input_file_name = input_file.split('.')[0]  # first part of filename only
+    return add_compression('{}_delta.txt'.format(input_file_name), compress)
+
+
+def get_stable_ids(connection):
+    "Returns a dict of sim_group_id --> stable id for the groups of the people in a database."
+    from itertools import groupby
+    from sqlalchemy.sql import select
+    from grouping import get_stable_id
+    import models
+
+    person = models.Person.__table__
+    rows = connection.execute(select([person.c.sim_group_id, person.c.source_person_id]).
+                              where(person.c.sim_group_id != None).order_by(person.c.sim_group_id))
+    return dict((group_id, get_stable_id(group_id, [source_person_id for _, source_person_id in group_rows]))
+                for group_id, group_rows in groupby(rows, key=lambda row: row[0]))
+
+
+def read_people(connection):
+    """
+    Yields (source_person_id, input_record, stable group id, first_name, last_name, email,
+    domain) for the people in a database, in source_person_id order.
+    """
+    from sqlalchemy.sql import select
+    import models
+
+    stable_ids = get_stable_ids(connection)
+    person = models.Person.__table__
+    for row in connection.execute(select([person.c.source_person_id, person.c.input_record, person.c.sim_group_id,
+                                          person.c.first_name, person.c.last_name, person.c.email, person.c.domain]).
+                                  order_by(person.c.source_person_id)):
+        yield (row[0], row[1], stable_ids.get(row[2])) + tuple(row[3:])
+
+
+def get_changes(previous_people, people):
+    """
+    Yields (change, person, previous person) for the people that were 'added', 'removed'
+    or 'changed' (in group, names, email or domain), from two iterables of people from
+    read_people(). person or previous person is None if the person was removed or added.
+    """
+    from grouping import get_source_id_key
+
+    previous_people, people = iter(previous_people), iter(people)
+    previous_person, person = next(previous_people, None), next(people, None)
+    while previous_person is not None or person is not None:
+        previous_key = get_source_id_key(previous_person[0]) if previous_person is not None else None
+        key = get_source_id_key(person[0]) if person is not None else None
+        if previous_key is None or (key is not None and key < previous_key):
+            yield 'added', person, None
+            person = next(people, None)
+        elif key is None or previous_key < key:
+            yield 'removed', None, previous_person
+            previous_person = next(previous_people, None)
+        else:
+            if person[2:] != previous_person[2:]:
+                yield 'changed', person, previous_person
+            previous_person, person = next(previous_people, None), next(people, None)
+
+
+def write_delta(session, previous_db_name, output_file_name, encoding, delimiter=u'\t'):
+    """
+    Writes the people that changed since the previous run (all of them, as added, if
+    there is no previous database) to a tab-delimited file, with their stable group
+    ids. Returns a dict of change --> number of people.
+    """
+    import os
+    import sqlalchemy
+    from compressed_io import open_text
+
+    previous_people = []
+    previous_engine = None
+    if previous_db_name and os.path.exists(previous_db_name):
+        previous_engine = sqlalchemy.create_engine('sqlite:///{}'.format(previous_db_name))
+        previous_people = read_people(previous_engine)
+    counts = {'added': 0, 'removed': 0, 'changed': 0}
+    with open_text(output_file_name, mode="w", encoding=encoding) as outfile:
+        outfile.write(delimiter.join(DELTA_COLUMNS) + u'\n')       # header row
+        for change, person, previous_person in get_changes(previous_people, read_people(session)):
+            counts[change] += 1
+            if person is None:      # removed: the person as they were, in no group now
+                person = previous_person[:2] + (None,) + previous_person[3:]
+            values = [change] + list(person) + [previous_person[2] if previous_person is not None else None]
+            outfile.write(delimiter.join(u'' if value is None else unicode(value) for value in values) + u'\n')
+    if previous_engine is not None:
+        previous_engine.dispose()
+    return counts
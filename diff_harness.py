@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: diff_harness.py
+"""
+Differential tests of the linkage pipeline: runs the reference implementation of
+each component side by side with its alternative engines on the same corpus,
+reports every person, score, sim or group assignment that differs, and the
+speedup of each engine.
+
+The references are the behaviour the output must not change from: the original
+name pattern loop and email regexes (checked against the guarded name parser and
+the single-scan email parser), get_sim_score() as it is, every pair of people scored for
+step 2, the original steps 3 and 3a run through the ORM, and a run of the whole
+process that isn't interrupted (compared with runs resumed after a crash in step
+3). To check a new engine, add a (name, function) to ENGINES under its component.
+
+Run from command line, e.g.
+#> python diff_harness.py <enter>
+#> python diff_harness.py names email --corpus input_file.txt --size 20000 --diff-file diffs.txt <enter>
+"""
+
+import random
+import sys
+import time
+
+CORPUS_SIZE = 2000          # records in the corpus (the people linked are the distinct ones)
+FUZZ_FRACTION = 0.25        # random records added to a generated corpus for the parsers, per record
+FUZZ_MAX_LENGTH = 80        # longest random record
+LONG_EMAIL_NAME_FRACTION = 0.02 # records with an email name longer than 64 characters, per record
+SCORE_PEOPLE = 300          # people whose every pair is scored by the scores component
+MAX_PRINTED_DIFFS = 10      # differences printed per engine (all are written to --diff-file)
+
+USAGE = """Pass the components to test (default: all), e.g.
+#> python diff_harness.py names email --corpus input_file.txt <enter>"""
+
+
+class ParsedPerson(object):
+    "A person with the Person attributes parsed from a record, without a database."
+    def __init__(self, person_id, source_id, record):
+        from person_parse import parse_person
+
+        self.id = person_id
+        for column, value in parse_person(source_id, record).items():
+            setattr(self, column, value)
+
+
+def make_corpus(source='generated', size=CORPUS_SIZE, seed=0):
+    """
+    Returns a list of (source id, record): generated records in the common formats
+    (see benchmarks.make_records) plus random ones, or a uniform sample of the records
+    of an input file.
+    """
+    if source == 'generated':
+        from benchmarks import make_records, make_fuzz_record
+
+        rng = random.Random(seed)
+        records = make_records(size, seed)
+        for source_id in range(size + 1, size + 1 + int(size * FUZZ_FRACTION)):
+            records.append((source_id, make_fuzz_record(rng.randint(0, FUZZ_MAX_LENGTH), rng)))
+        for _ in range(int(size * LONG_EMAIL_NAME_FRACTION)):
+            records.append((len(records) + 1, make_long_email_name_record(rng)))
+        return records
+    from get_sample_data import read_records, Reservoir
+
+    reservoir = Reservoir(size, random.Random(seed))
+    for person_id, person in read_records(source):
+        reservoir.add(person_id, person)
+    return reservoir.records
+
+
+def make_long_email_name_record(rng):
+    "Returns a record whose email name is longer than 64 characters, e.g. (a) johnjohn...john.smith@z.com."
+    from benchmarks import FIRST_NAMES, LAST_NAMES, DOMAINS
+
+    first = rng.choice(FIRST_NAMES)
+    return u'({}) {}{}{}@{}'.format(rng.choice(u'ab'), first * (64 // len(first) + rng.randint(1, 10)), rng.choice(u'._'),
+                                    rng.choice(LAST_NAMES).replace(' ', ''), rng.choice(DOMAINS))
+
+
+def get_people(corpus):
+    "Returns a list of ParsedPerson for the distinct non-blank records (as step 1 loads them)."
+    people, seen = [], set()
+    for source_id, record in corpus:
+        if record and record not in seen:
+            seen.add(record)
+            people.append(ParsedPerson(len(people) + 1, source_id, record))
+    return people
+
+
+# ** Parsers **
+
+def get_firstname_lastname_unguarded(record):
+    "The original name pattern loop, without the length cap and pre-check guards of get_firstname_lastname()."
+    import patterns
+
+    for number, p in enumerate(patterns.name_patterns, 1):
+        match_object = p.search(record) if p is patterns.pattern_names_8 else p.match(record)
+        if match_object:
+            return (match_object.group('first').strip().lower(), match_object.group('last').strip().lower(), number)
+    return ("", "", -1)
+
+
+def parse_names(inputs, parse=get_firstname_lastname_unguarded):
+    return dict((record, parse(record)) for record in inputs['records'])
+
+
+def parse_names_guarded(inputs):
+    from person_parse import get_firstname_lastname
+    return parse_names(inputs, get_firstname_lastname)
+
+
+def parse_emails(inputs, parse=None):
+    from person_parse import get_email_name_domain_regex
+    parse = parse or get_email_name_domain_regex
+    return dict((record, parse(record)) for record in inputs['records'])
+
+
+def parse_emails_single_scan(inputs):
+    from person_parse import get_email_name_domain
+    return parse_emails(inputs, get_email_name_domain)
+
+
+# ** Scores **
+
+def score_pairs(inputs, score=None):
+    "Returns a dict of (person id, person id) --> score for every ordered pair of people."
+    from person_parse import get_sim_score
+    score = score or get_sim_score
+    people = inputs['people'][:SCORE_PEOPLE]
+    return dict(((a.id, b.id), score(a, b)) for a in people for b in people if a is not b)
+
+
+def score_by_signature(inputs):
+    "Scores each pair of signatures once (as step 2 does), checking that get_signature() covers the score."
+    from person_parse import get_sim_score, get_signature
+
+    cache = {}
+
+    def score(a, b):
+        key = (get_signature(a), get_signature(b))
+        if key not in cache:
+            cache[key] = get_sim_score(a, b)
+        return cache[key]
+    return score_pairs(inputs, score)
+
+
+def score_tfidf_fallback(inputs):
+    "Scores with the TF-IDF engine at a cosine similarity of 0, which must fall back to the rules."
+    from tfidf import get_tfidf_score
+    return score_pairs(inputs, lambda a, b: get_tfidf_score(a, b, 0.0))
+
+
+# ** Step 2: sims **
+
+def find_sims_all_pairs(inputs):
+    "Returns a dict of person id --> tuple of the ids of their sims, scoring every pair of people."
+    from person_parse import get_sim_score
+
+    people, score_threshold = inputs['people'], inputs['score_threshold']
+    return dict((a.id, tuple(b.id for b in people if a is not b and get_sim_score(a, b) >= score_threshold))
+                for a in people)
+
+
+def get_signature_sims(inputs, block_size_cap=None):
+    "Returns (signatures, list of similar signature numbers per signature) as step 2 finds them."
+    from blocking import group_by_signature, plan_blocks
+    from run_process import score_signatures
+
+    signatures = group_by_signature(inputs['people'])
+    plan = plan_blocks([people[0] for people in signatures], inputs['score_threshold'],
+                       block_size_cap=block_size_cap)
+    return signatures, [similar for _, similar in score_signatures(signatures, plan, inputs['score_threshold'])]
+
+
+def find_sims_blocked(inputs, block_size_cap=None):
+    "Returns the sims as step 2 creates them in the sims table: signatures scored in blocks."
+    signatures, sims = get_signature_sims(inputs, block_size_cap)
+    result = {}
+    for i, similar in enumerate(sims):
+        similar_people = [b.id for j in similar for b in signatures[j]]
+        for a in signatures[i]:
+            result[a.id] = tuple(sorted(b_id for b_id in similar_people if b_id != a.id))
+    return result
+
+
+def find_sims_csr(inputs):
+    "Returns the sims as step 2 keeps them with --sims-storage csr (see sim_graph.py)."
+    from sim_graph import SimGraph
+
+    signatures, sims = get_signature_sims(inputs)
+    graph = SimGraph.from_lists([[person.id for person in people] for people in signatures], sims)
+    return dict((person.id, tuple(sorted(graph.get_similar(person.id)))) for person in inputs['people'])
+
+
+def find_sims_in_candidates(inputs):
+    """
+    Returns the sims (see find_sims_all_pairs) among the people models.get_candidates()
+    looks up for each person, which must be all of them: the candidates are a superset.
+    """
+    import models
+
+    session, sims = inputs['candidates_session'], inputs['sims']
+    result = {}
+    for person in inputs['people']:
+        candidates = set(person_id for person_id, in
+                         models.get_candidates(session, person).with_entities(models.Person.id))
+        result[person.id] = tuple(person_id for person_id in sims[person.id] if person_id in candidates)
+    return result
+
+
+# ** Steps 3 and 3a: groups **
+
+def make_reference_db(people, sims):
+    "Returns a session on an in-memory database of the people and their sims, as after step 2."
+    import sqlalchemy
+    import sqlalchemy.orm
+    import models
+
+    engine = sqlalchemy.create_engine('sqlite://')
+    models.Base.metadata.create_all(engine)
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    models.make_sim_group_1(session)
+    for person in people:
+        row = models.Person(person.source_person_id, person.input_record)
+        row.id = person.id
+        session.add(row)
+    session.flush()
+    sims_rows = [{'left_person_id': a, 'right_person_id': b} for a in sorted(sims) for b in sims[a]]
+    if sims_rows:
+        session.execute(models.sims.insert(), sims_rows)
+    session.commit()
+    return session
+
+
+def assign_groups_orm(inputs):
+    """
+    Returns a dict of person id --> group id from the original steps 3 and 3a: a loop
+    over Person objects and their similar_people through the ORM.
+    """
+    import sqlalchemy
+    from sqlalchemy.sql import select
+    from person_parse import same_group, same_names
+    import models
+
+    session = inputs['reference_session']
+    # ** Step 3 **
+    for person in session.query(models.Person).all():
+        if person.sim_group_id:
+            continue
+        sims = person.similar_people
+        if not sims:
+            person.sim_group_id = 1
+            session.add(person)
+        else:
+            session.add(models.Sim_group(people=[person] + list(sims)))
+        session.flush()
+    session.commit()
+    # ** Step 3a **
+    people_alone_in_a_group = select([models.Person.id]).group_by(models.Person.sim_group_id).\
+        having(sqlalchemy.func.count(models.Person.id) == 1)
+    for p in session.query(models.Person).filter(models.Person.id.in_(people_alone_in_a_group)).all():
+        old_group_id = p.sim_group_id
+        same_grp = same_group(p.similar_people)
+        if same_grp and same_names(p.similar_people):
+            p.sim_group_id = same_grp
+        else:
+            p.sim_group_id = 1
+        session.delete(session.query(models.Sim_group).filter_by(id=old_group_id).one())
+    session.commit()
+    return dict(session.query(models.Person.id, models.Person.sim_group_id))
+
+
+def assign_groups_in_memory(inputs):
+    "Returns a dict of person id --> group id from grouping.assign_groups() (steps 3 and 3a in memory)."
+    from grouping import assign_groups
+
+    people, sims = inputs['people'], inputs['sims']
+    names = dict((person.id, (person.first_name, person.last_name)) for person in people)
+    group_of, _ = assign_groups([person.id for person in people], lambda person_id: sims[person_id], names)
+    return group_of
+
+
+# ** Resumed runs **
+
+class SimulatedCrash(Exception):
+    pass
+
+
+def crash(*args, **kwargs):
+    raise SimulatedCrash()
+
+
+def run_file(inputs, crash_in_step_3=False, **options):
+    """
+    Runs the process on the corpus written to an input file, in a temporary directory, and
+    returns a dict of person_id --> the rest of their row in the report. If crash_in_step_3
+    is True, the run is first interrupted in step 3 and then resumed.
+    """
+    import codecs
+    import os
+    import shutil
+    import tempfile
+    import run_process
+
+    directory = tempfile.mkdtemp()
+    cwd, stdout = os.getcwd(), sys.stdout
+    try:
+        os.chdir(directory)
+        sys.stdout = open(os.devnull, 'w')
+        with codecs.open('corpus.txt', mode="w", encoding=run_process.ENCODING) as f:
+            f.write(u'person_id\tinput_record\n')
+            for source_id, record in inputs['corpus']:
+                f.write(u'{}\t{}\n'.format(source_id, record.replace(u'\t', u' ').replace(u'\n', u' ')))
+        options.update(score_threshold=inputs['score_threshold'], progress_interval=0)
+        if crash_in_step_3:
+            step_3_create_groups = run_process.step_3_create_groups
+            run_process.step_3_create_groups = crash
+            try:
+                run_process.process_file('corpus.txt', **options)
+            except SimulatedCrash:
+                pass
+            finally:
+                run_process.step_3_create_groups = step_3_create_groups
+            options['resume'] = True
+        run_process.process_file('corpus.txt', **options)
+        with codecs.open(run_process.get_output_file_name('corpus.txt'), encoding=run_process.ENCODING) as f:
+            next(f)
+            return dict(line.rstrip(u'\n').split(u'\t', 1) for line in f)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+# component --> (reference, [(engine name, engine)])
+COMPONENTS = ['names', 'email', 'scores', 'sims', 'candidates', 'groups', 'resume']
+REFERENCES = {
+    'names': parse_names,
+    'email': parse_emails,
+    'scores': score_pairs,
+    'sims': find_sims_all_pairs,
+    'candidates': find_sims_all_pairs,
+    'groups': assign_groups_orm,
+    'resume': run_file,
+}
+ENGINES = {
+    'names': [('guarded', parse_names_guarded)],
+    'email': [('single_scan', parse_emails_single_scan)],
+    'scores': [('signature_cache', score_by_signature), ('tfidf_fallback', score_tfidf_fallback)],
+    'sims': [('blocked', find_sims_blocked), ('csr', find_sims_csr)],
+    'candidates': [('get_candidates', find_sims_in_candidates)],
+    'groups': [('in_memory', assign_groups_in_memory)],
+    'resume': [('table', lambda inputs: run_file(inputs, crash_in_step_3=True)),
+               ('csr_spanning', lambda inputs: run_file(inputs, crash_in_step_3=True, sims_storage='csr',
+                                                        spanning_sims=True))],
+}
+
+
+def get_inputs(corpus, components, score_threshold):
+    "Returns a dict of the inputs of the components: corpus, records, people, and the reference sims and databases."
+    inputs = {'records': sorted(set(record for _, record in corpus)), 'score_threshold': score_threshold,
+              'corpus': corpus}
+    if set(components) & set(['scores', 'sims', 'candidates', 'groups']):
+        inputs['people'] = get_people(corpus)
+    if set(components) & set(['candidates', 'groups']):
+        inputs['sims'] = find_sims_all_pairs(inputs)
+    if 'candidates' in components:
+        inputs['candidates_session'] = make_reference_db(inputs['people'], {})
+    if 'groups' in components:
+        inputs['reference_session'] = make_reference_db(inputs['people'], inputs['sims'])
+    return inputs
+
+
+def get_differences(reference_result, result):
+    "Returns a sorted list of (item, reference value, engine value) for the items whose values differ."
+    return sorted((item, reference_result.get(item), result.get(item))
+                  for item in set(reference_result) | set(result)
+                  if reference_result.get(item) != result.get(item))
+
+
+def timed(function, inputs):
+    "Returns (what a function returned, the seconds it took)."
+    start = time.time()
+    result = function(inputs)
+    return result, time.time() - start
+
+
+def run_component(component, inputs, diff_file=None):
+    """
+    Runs a component's reference and each of its engines, and prints their differences
+    (writing all of them to diff_file if given) and speedups. Returns the number of
+    differences.
+    """
+    reference_result, reference_time = timed(REFERENCES[component], inputs)
+    print '{}: reference {:.3f} s, {} items'.format(component, reference_time, len(reference_result))
+    count_differences = 0
+    for name, engine in ENGINES[component]:
+        result, engine_time = timed(engine, inputs)
+        differences = get_differences(reference_result, result)
+        count_differences += len(differences)
+        print '  {}: {:.3f} s ({:.1f}x), {}'.format(name, engine_time, reference_time / max(engine_time, 1e-9),
+                                                   '{} DIFFERENCES'.format(len(differences)) if differences else 'identical')
+        for item, reference_value, value in differences[:MAX_PRINTED_DIFFS]:
+            print u'    {!r}: reference {!r}, {} {!r}'.format(item, reference_value, name, value).encode('utf-8')
+        if diff_file:
+            for item, reference_value, value in differences:
+                diff_file.write(u'{}\t{}\t{!r}\t{!r}\t{!r}\n'.format(component, name, item, reference_value, value))
+    return count_differences
+
+
+def parse_args(argv):
+    "Parses command line arguments. Exits with the usage message if they are incorrect."
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare the pipeline with its reference implementation.',
+                                     usage=USAGE)
+    # python 2's argparse checks the default of a '*' positional against its choices
+    parser.add_argument('components', nargs='*', choices=COMPONENTS + [[]], default=[],
+                        help='components to test (default: all)')
+    parser.add_argument('--corpus', default='generated', metavar='FILE',
+        help="'generated' (the default) or an input file to sample records from")
+    parser.add_argument('--size', type=int, default=CORPUS_SIZE, metavar='N',
+        help='number of records in the corpus (default {})'.format(CORPUS_SIZE))
+    parser.add_argument('--seed', type=int, default=0, help='seed for generating or sampling the corpus')
+    parser.add_argument('--score-threshold', type=int, default=50, metavar='SCORE',
+        help='score threshold of step 2 (default 50)')
+    parser.add_argument('--diff-file', metavar='FILE', help='write every difference to FILE (tab-delimited)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    "Command line entry point. Returns a process exit code: 1 if any engine differs from its reference."
+    import codecs
+
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    components = args.components or COMPONENTS
+    corpus = make_corpus(args.corpus, args.size, args.seed)
+    print '{} records from the {} corpus.'.format(len(corpus), args.corpus)
+    inputs = get_inputs(corpus, components, args.score_threshold)
+
+    diff_file = codecs.open(args.diff_file, mode="w", encoding='utf-8') if args.diff_file else None
+    try:
+        count_differences = sum(run_component(component, inputs, diff_file) for component in components)
+    finally:
+        if diff_file:
+            diff_file.close()
+    print '{} differences in total.'.format(count_differences)
+    return 1 if count_differences else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
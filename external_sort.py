@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: external_sort.py
+"""
+A chunked external merge sort for sorting more rows than fit in a memory
+budget. Rows are collected into chunks of roughly budget size, each chunk is
+sorted in memory and spilled to a temp file (a "run"), and the runs are then
+merged lazily with heapq.merge. If everything fits in one chunk nothing is
+written to disk.
+"""
+
+import heapq
+import marshal
+import tempfile
+
+ROW_OVERHEAD = 64           # approximate bytes of python object overhead per row
+RUN_BLOCK_SIZE = 1000       # rows marshalled together when writing a run to disk
+
+
+def estimate_row_size(row):
+    "Returns a rough estimate of the memory used by a row (a tuple of simple values)."
+    size = ROW_OVERHEAD
+    for value in row:
+        if isinstance(value, basestring):
+            size += 2 * len(value)
+        else:
+            size += 8
+    return size
+
+
+def write_run(rows, tmp_dir=None):
+    "Writes sorted rows to a temp file and returns the file, rewound to the start."
+    f = tempfile.TemporaryFile(dir=tmp_dir)
+    for start in range(0, len(rows), RUN_BLOCK_SIZE):
+        marshal.dump(rows[start:start + RUN_BLOCK_SIZE], f)
+    f.seek(0)
+    return f
+
+
+def read_run(f):
+    "Yields rows from a run written by write_run(), then closes (and deletes) the file."
+    try:
+        while True:
+            try:
+                block = marshal.load(f)
+            except EOFError:
+                break
+            for row in block:
+                yield row
+    finally:
+        f.close()
+
+
+def external_sort(rows, key, memory_budget, tmp_dir=None):
+    """
+    Yields rows (tuples of ints, strings or None) from an iterable in sorted
+    order by key(row), holding at most about memory_budget bytes of rows in
+    memory at a time. Rows with equal keys keep their input order.
+    """
+    runs = []
+    chunk = []
+    chunk_size = 0
+    for row in rows:
+        # decorate with the key and a sequence number, so the sort is stable
+        # and heapq.merge never has to compare the rows themselves
+        chunk.append((key(row), len(runs), len(chunk), tuple(row)))
+        chunk_size += estimate_row_size(row)
+        if chunk_size >= memory_budget:
+            chunk.sort()
+            runs.append(write_run(chunk, tmp_dir))
+            chunk = []
+            chunk_size = 0
+    chunk.sort()
+
+    if not runs:
+        # everything fit in memory; no need to merge
+        for decorated in chunk:
+            yield decorated[-1]
+        return
+
+    if chunk:
+        runs.append(write_run(chunk, tmp_dir))
+    for decorated in heapq.merge(*[read_run(f) for f in runs]):
+        yield decorated[-1]
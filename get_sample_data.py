@@ -3,57 +3,197 @@
 # module: get_sample_data.py
 """
 Pull a random sample of people records from an input file.
+
+The file is read once, keeping only a reservoir of sampled records, so any size
+of file can be sampled in memory bounded by the sample size. A stratified sample
+reads the file twice: first to count the records of each name pattern or email
+domain, then to sample each with a reservoir of its share of the sample (in
+proportion to its number of records), so the memory is still bounded by the
+sample size (and the number of strata). Duplicated records are skipped (see
+dedup.py), and their counts written to a file.
+
+Run from command line, passing name of input file as an argument, e.g.
+#> python get_sample_data.py input_file.txt <enter>
+#> python get_sample_data.py input_file.txt --size 10000 --stratify domain <enter>
 """
 
 import sys
 import codecs
 import random
 
-# check for correct usage and print error message if incorrect.
-if len(sys.argv) != 2:
-    print """Error. Pass the name of the input file as an argument, e.g. 
-#> python run_process.py input_file.txt <enter>"""
-    sys.exit()
-
-INPUT_FILE = sys.argv[1]                        # full name with extension
 SAMPLE_SIZE = 1000
 HEADER_ROW = True                               # first row of input file contains field names?
 ENCODING = 'utf-16'                             # 'utf-8', 'latin-1', or 'utf-16' when saved Excel as unicode.txt
-INPUT_FILE_NAME = INPUT_FILE.split('.')[0]      # first part of filename only
-OUTPUT_FILE_NAME = '{}_test.txt'.format(INPUT_FILE_NAME)
 DELIMETER = '\t'
+MAX_STRATA = 1000                               # records of further strata are sampled together as OTHER_STRATUM
+OTHER_STRATUM = u'(other)'
+
+USAGE = """Error. Pass the name of the input file as an argument, e.g.
+#> python get_sample_data.py input_file.txt <enter>"""
+
+
+def get_output_file_name(input_file):
+    "Returns the name of the sample file for a given input file."
+    input_file_name = input_file.split('.')[0]  # first part of filename only
+    return '{}_test.txt'.format(input_file_name)
+
+
+def read_records(input_file):
+    "Yields a tuple for each non-blank record in the file (which may be compressed): (person_id, person)."
+    from compressed_io import open_text
 
+    with open_text(input_file, mode="r", encoding=ENCODING) as f:
+        if HEADER_ROW:
+            next(f)    # skip first line in input file
+        for row in f:
+            row = row.split(DELIMETER)
+            person_id = row[0]  # the source system ID for the record
+            person = row[1].strip()
+            if person:
+                yield person_id, person
 
-# 1. Read the file into a list of tuples: (person_id, person)
-input_record_list = []
-with codecs.open(INPUT_FILE, mode="r", encoding=ENCODING) as f:
-    count_input_records = 0
-    records_processed = dict()  # prevents adding the same record twice if duplicated in INPUT_FILE
-    if HEADER_ROW:
-        next(f)    # skip first line in input file
-    for row in f:
-        row = row.split(DELIMETER)
-        person_id = row[0]  # the source system ID for the record
-        person = row[1].strip()
-        if person and not person in records_processed:
-            records_processed[person] = 1
-            input_record_list.append((person_id, person))
-            count_input_records += 1
+
+class Reservoir(object):
+    """
+    A uniform random sample of up to size records from a stream of records (reservoir
+    sampling, Algorithm R).
+    """
+    def __init__(self, size, rng=random):
+        self.size = size
+        self.rng = rng
+        self.records = []       # list of (person_id, person)
+        self.count = 0          # records offered
+
+    def add(self, person_id, person):
+        self.count += 1
+        if len(self.records) < self.size:
+            self.records.append((person_id, person))
         else:
-            records_processed[person] += 1
+            i = self.rng.randint(0, self.count - 1)
+            if i < self.size:   # replace a random record, with probability size / count
+                self.records[i] = (person_id, person)
+
+
+def get_stratum_key(stratify):
+    "Returns a function returning the stratum of a record: its name pattern or email domain."
+    from person_parse import get_firstname_lastname, get_email_name_domain
+
+    if stratify == 'pattern':
+        return lambda person: get_firstname_lastname(person)[2] or u''
+    elif stratify == 'domain':
+        return lambda person: get_email_name_domain(person)[2] or u''
+    raise ValueError('Unknown stratum: {}'.format(stratify))
+
+
+def allocate(counts, sample_size):
+    """
+    Returns the number of records to take from each stratum, in proportion to its count
+    of records (largest remainder method), given a dict of stratum --> count.
+    """
+    total = sum(counts.values())
+    if total <= sample_size:
+        return dict(counts)
+    quotas = dict((stratum, float(sample_size) * count / total) for stratum, count in counts.items())
+    allocation = dict((stratum, int(quota)) for stratum, quota in quotas.items())
+    remainders = sorted(quotas, key=lambda stratum: (allocation[stratum] - quotas[stratum], stratum))
+    for stratum in remainders[:sample_size - sum(allocation.values())]:
+        allocation[stratum] += 1
+    return allocation
+
+
+def skip_duplicates(records, deduplicator):
+    "Yields the records that the deduplicator hasn't seen before."
+    for person_id, person in records:
+        if not deduplicator.is_duplicate(person):
+            yield person_id, person
+
+
+def sample_records(get_records, sample_size=SAMPLE_SIZE, stratify=None, rng=random):
+    """
+    Returns (list of sampled (person_id, person), the Deduplicator that skipped
+    duplicated records), given a function returning an iterable of records. If
+    stratify is 'pattern' or 'domain', each stratum is sampled in proportion to its
+    size, and the records are read twice.
+    """
+    from dedup import Deduplicator
+
+    if not stratify:
+        deduplicator = Deduplicator()
+        reservoir = Reservoir(sample_size, rng)
+        for person_id, person in skip_duplicates(get_records(), deduplicator):
+            reservoir.add(person_id, person)
+        return reservoir.records, deduplicator
+
+    # 1. count the records of each stratum
+    stratum_key = get_stratum_key(stratify)
+    counts = {}
+    for person_id, person in skip_duplicates(get_records(), Deduplicator()):
+        stratum = stratum_key(person)
+        if stratum not in counts and len(counts) >= MAX_STRATA:
+            stratum = OTHER_STRATUM
+        counts[stratum] = counts.get(stratum, 0) + 1
+
+    # 2. sample each stratum with a reservoir of its allocation (the same records are skipped)
+    allocation = allocate(counts, sample_size)
+    reservoirs = dict((stratum, Reservoir(size, rng)) for stratum, size in allocation.items() if size)
+    deduplicator = Deduplicator()
+    for person_id, person in skip_duplicates(get_records(), deduplicator):
+        stratum = stratum_key(person)
+        reservoir = reservoirs.get(stratum if stratum in counts else OTHER_STRATUM)
+        if reservoir is not None:
+            reservoir.add(person_id, person)
+    sample_list = []
+    for stratum in sorted(reservoirs):
+        sample_list.extend(reservoirs[stratum].records)
+    return sample_list, deduplicator
+
+
+def write_sample(sample_list, output_file_name):
+    "Writes the sample to a tab-delimited output file."
+    with codecs.open(output_file_name, mode="w", encoding=ENCODING) as outfile:
+        outfile.write(u'person_id{}person\n'.format(DELIMETER))        # write header row
+        for person in sample_list:
+            line = u'{0}{1}{2}\n'.format(person[0], DELIMETER, person[1])
+            outfile.write(line)
+
+
+def parse_args(argv):
+    "Parses command line arguments. Exits with the usage message if they are incorrect."
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Pull a random sample of people records.', usage=USAGE)
+    parser.add_argument('input_file', help='two-column, tab-delimited input file')
+    parser.add_argument('--size', type=int, default=SAMPLE_SIZE, metavar='N',
+        help='number of records to sample (default {})'.format(SAMPLE_SIZE))
+    parser.add_argument('--stratify', choices=['pattern', 'domain'],
+        help='sample each name pattern or email domain in proportion to its number of records')
+    parser.add_argument('--seed', type=int, help='seed for the random number generator')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    "Command line entry point. Returns a process exit code."
+    from dedup import get_duplicates_file_name, write_duplicates
+
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    output_file_name = get_output_file_name(args.input_file)   # full name with extension
+    rng = random.Random(args.seed)
 
-for person, count in records_processed.iteritems():
-    if count > 1:
-        print '{0}:{1}'.format(person, count)
+    # 1. read the file (twice if stratified), keeping a random sample of its records
+    sample_list, deduplicator = sample_records(lambda: read_records(args.input_file), args.size,
+                                               args.stratify, rng)
+    print '{0} records read.'.format(deduplicator.count)
+    if deduplicator.count_duplicates:
+        duplicates_file_name = get_duplicates_file_name(args.input_file)
+        write_duplicates(deduplicator, duplicates_file_name, ENCODING)
+        print '{0} duplicate records skipped ({1} distinct); counts written to {2}.'.format(
+            deduplicator.count_duplicates, len(deduplicator.duplicates), duplicates_file_name)
 
-# 2. select a random sample from the list into a new list
-sample_list = random.sample(input_record_list, SAMPLE_SIZE)
+    # 2. write the sample to a tab-delimited output file
+    write_sample(sample_list, output_file_name)
+    print '{0} records written to {1}'.format(len(sample_list), output_file_name)
+    return 0
 
-# 3. write the sample to a pipe-delimited output file
-with codecs.open(OUTPUT_FILE_NAME, mode="w", encoding=ENCODING) as outfile:
-    outfile.write(u'person_id{}person\n'.format(DELIMETER))        # write header row
-    for person in sample_list:
-        line = u'{0}{1}{2}\n'.format(person[0], DELIMETER, person[1])
-        outfile.write(line)
 
-print '{0} records written to {1}'.format(SAMPLE_SIZE, OUTPUT_FILE_NAME)
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: grouping.py
+"""
+Arranges people into groups based on their sims (steps 3 and 3a), in memory,
+from any source of sims: the sims table, or the compact graph in sim_graph.py.
+The groups are then saved to the database with a few bulk statements instead
+of loading each person's similar_people through the ORM.
+"""
+
+from collections import Counter
+
+MISC_GROUP_ID = 1           # the default group, for people who don't have any similar people
+STABLE_MISC_GROUP_ID = 0    # the stable id of the misc group
+
+
+def get_same_group(similar_people, group_of):
+    """
+    Returns the group id if all the people are in the same group, False if they
+    are not, and None if there are no people (like same_group() in person_parse).
+    """
+    group_id = None
+    for person_id in similar_people:
+        if group_id and (group_id != group_of.get(person_id)):
+            return False
+        group_id = group_of.get(person_id)
+    return group_id
+
+
+def have_same_names(similar_people, names):
+    "Returns True if all the people have the same first and last names (like same_names() in person_parse)."
+    return len(set(names[person_id] for person_id in similar_people)) <= 1
+
+
+def split_group(person_id, similar_people, group_of, names, max_group_size, get_scores):
+    """
+    Returns the sims to put in a group with a person whose sims would make it larger
+    than max_group_size: of the sims not in a group yet, the max_group_size - 1 that
+    score highest with the person (on a tie, those with the person's names first, then
+    in id order). This drops the weakest links of a hub, e.g. a shared email or a common
+    name, rather than chaining everyone through it. get_scores(person_id, ids) returns
+    the person's score with each of the people.
+    """
+    candidates = [similar_person_id for similar_person_id in similar_people if not group_of.get(similar_person_id)]
+    if len(candidates) < max_group_size:
+        return candidates
+    scores = get_scores(person_id, candidates)
+    ranked = sorted(zip(scores, candidates), key=lambda pair: (-pair[0], names[pair[1]] != names[person_id], pair[1]))
+    return [similar_person_id for _, similar_person_id in ranked[:max_group_size - 1]]
+
+
+def assign_groups(person_ids, get_similar, names, first_group_id=MISC_GROUP_ID + 1, progress=None,
+                  max_group_size=None, get_scores=None, split_people=None):
+    """
+    Returns (dict of person id --> group id, set of group ids) for people, given
+    their ids in id order, a function returning the ids of a person's sims, and a
+    dict of person id --> (first_name, last_name). New groups are numbered from
+    first_group_id in the order they are created. The people are counted on
+    progress (see progress.py), if given.
+    If max_group_size is given, no group gets more people than that: a person whose
+    sims would make a larger group only gets the best of them (see split_group(), which
+    scores them with get_scores), and their ids are appended to split_people, if given.
+    """
+    group_of = {}
+    groups = set([MISC_GROUP_ID])
+    next_group_id = first_group_id
+
+    # ** Step 3 **
+    # Put each person who hasn't been grouped yet in a new group with their sims.
+    # Records with no sims go into the misc group.
+    for person_id in person_ids:
+        if progress is not None:
+            progress.update()
+        if group_of.get(person_id):         # person has already been grouped
+            continue
+        similar_people = get_similar(person_id)
+        if max_group_size and len(similar_people) >= max_group_size:
+            similar_people = split_group(person_id, similar_people, group_of, names, max_group_size,
+                                         get_scores)
+            if split_people is not None:
+                split_people.append(person_id)
+            if not similar_people:          # all their sims are in groups already: see step 3a
+                group_of[person_id] = next_group_id
+                groups.add(next_group_id)
+                next_group_id += 1
+                continue
+        if not similar_people:              # person has no sims
+            group_of[person_id] = MISC_GROUP_ID
+        else:                               # put person and their sims into a new group
+            group_of[person_id] = next_group_id
+            for similar_person_id in similar_people:
+                group_of[similar_person_id] = next_group_id
+            groups.add(next_group_id)
+            next_group_id += 1
+
+    # ** Step 3a **
+    # At this stage there can be a person in a group by themself. They are moved to
+    # the group of their sims if all their sims are in one group and have the same
+    # names (and the group isn't full), otherwise to the misc group. Either way their
+    # old group is deleted.
+    group_sizes = Counter(group_of.values())
+    single_grouped_people = [person_id for person_id in person_ids if group_sizes[group_of[person_id]] == 1]
+    for person_id in single_grouped_people:
+        old_group_id = group_of[person_id]
+        similar_people = get_similar(person_id)
+        same_group_id = get_same_group(similar_people, group_of)
+        if same_group_id and have_same_names(similar_people, names) and \
+                not (max_group_size and group_sizes[same_group_id] >= max_group_size):
+            group_of[person_id] = same_group_id
+            group_sizes[same_group_id] += 1
+        else:
+            group_of[person_id] = MISC_GROUP_ID
+        if group_of[person_id] == old_group_id:
+            # only when the misc group had a single person: deleting it leaves them without a group
+            group_of[person_id] = None
+        groups.discard(old_group_id)
+    return group_of, groups
+
+
+def save_groups(session, group_of, groups):
+    "Saves groups from assign_groups() to the database: the sim_group rows and each person's sim_group_id."
+    from sqlalchemy.sql import bindparam
+    import models
+
+    new_groups = [{'id': group_id, 'is_misc': False} for group_id in sorted(groups) if group_id != MISC_GROUP_ID]
+    if new_groups:
+        session.execute(models.Sim_group.__table__.insert(), new_groups)
+    if MISC_GROUP_ID not in groups:
+        session.execute(models.Sim_group.__table__.delete().where(models.Sim_group.id == MISC_GROUP_ID))
+    person = models.Person.__table__
+    update_group = person.update().where(person.c.id == bindparam('person_id')).\
+        values(sim_group_id=bindparam('group_id'))
+    rows = [{'person_id': person_id, 'group_id': group_id} for person_id, group_id in group_of.items()]
+    for start in range(0, len(rows), 10000):
+        session.execute(update_group, rows[start:start + 10000])
+
+
+def get_most_common(values):
+    "Returns the most common of the values that aren't blank, the first seen on a tie, or None."
+    counts = {}
+    for position, value in enumerate(values):
+        if value:
+            count, first_position = counts.get(value, (0, position))
+            counts[value] = (count + 1, first_position)
+    if not counts:
+        return None
+    return max(counts, key=lambda value: (counts[value][0], -counts[value][1]))
+
+
+def format_name(first_name, last_name):
+    "Returns a person's name as in the report's full_name ('Last, First'), or whichever name they have."
+    if first_name and last_name:
+        return u'{}, {}'.format(last_name, first_name).title()
+    return (first_name or last_name).title()
+
+
+def get_source_id_key(source_person_id):
+    """
+    Returns a sort key for a source_person_id that orders them as SQLite does: numbers
+    (stored as integers) before text, and text by its UTF-8 bytes.
+    """
+    if source_person_id is None:
+        return (0,)
+    if isinstance(source_person_id, basestring):
+        return (2, source_person_id.encode('utf-8'))
+    return (1, source_person_id)
+
+
+def get_stable_id(group_id, source_person_ids):
+    """
+    Returns the stable id of a group, which doesn't depend on the order the groups
+    were created in: the smallest source_person_id of its people, or
+    STABLE_MISC_GROUP_ID for the misc group.
+    """
+    if group_id == MISC_GROUP_ID:
+        return STABLE_MISC_GROUP_ID
+    return min(source_person_ids, key=get_source_id_key)
+
+
+def get_canonical_records(rows):
+    """
+    Yields (group id, canonical name, canonical email, size, stable id) for each group,
+    from (sim_group_id, first_name, last_name, email, source_person_id) rows ordered by
+    sim_group_id. The canonical name is the most common (first name, last name) in the
+    group and the canonical email the most common email. The misc group has only a size
+    and stable id.
+    """
+    from itertools import groupby
+
+    for group_id, group_rows in groupby(rows, key=lambda row: row[0]):
+        if group_id == MISC_GROUP_ID:
+            yield group_id, None, None, sum(1 for _ in group_rows), STABLE_MISC_GROUP_ID
+            continue
+        group_rows = list(group_rows)
+        name = get_most_common([(first_name, last_name) for _, first_name, last_name, _, _ in group_rows
+                                if first_name or last_name])
+        email = get_most_common([email for _, _, _, email, _ in group_rows])
+        yield (group_id, format_name(*name) if name else None, email, len(group_rows),
+               get_stable_id(group_id, [source_person_id for _, _, _, _, source_person_id in group_rows]))
+
+
+def save_canonical_records(session):
+    """
+    Sets the canonical name, canonical email, size and stable id of every group in the
+    database in one pass over the people ordered by sim_group_id (see
+    get_canonical_records). Returns the number of groups updated.
+    """
+    from sqlalchemy.sql import select, bindparam
+    import models
+
+    person = models.Person.__table__
+    sim_group = models.Sim_group.__table__
+    update_group = sim_group.update().where(sim_group.c.id == bindparam('group_id')).values(
+        canonical_name=bindparam('name'), canonical_email=bindparam('email'), size=bindparam('group_size'),
+        stable_id=bindparam('group_stable_id'))
+    rows = session.execute(
+        select([person.c.sim_group_id, person.c.first_name, person.c.last_name, person.c.email,
+                person.c.source_person_id]).
+        where(person.c.sim_group_id != None).order_by(person.c.sim_group_id, person.c.id))
+    # the people are streamed; only one row per group is kept, and written after the pass
+    groups = [{'group_id': group_id, 'name': name, 'email': email, 'group_size': size, 'group_stable_id': stable_id}
+              for group_id, name, email, size, stable_id in get_canonical_records(rows)]
+    for start in range(0, len(groups), 10000):
+        session.execute(update_group, groups[start:start + 10000])
+    return len(groups)
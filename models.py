@@ -7,10 +7,10 @@ SQL database.
 """
 
 from sqlalchemy import Column, Integer, String, Boolean, Sequence, \
-                       create_engine, ForeignKey, UniqueConstraint, Table
+                       create_engine, ForeignKey, UniqueConstraint, Table, Index, or_, and_, false, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref, sessionmaker
-from person_parse import get_firstname_lastname, get_email_name_domain, get_n_grams
+from person_parse import parse_person, MAX_FIRST_NAME_DISTANCE, MIN_FUZZY_NAME_LENGTH
 
 Base = declarative_base()
 
@@ -29,28 +29,85 @@ class Person(Base):
     first_name = Column(String(100))
     last_name = Column(String(100))
     email = Column(String(100))
+    email_name = Column(String(100))   # the part of the email address before the @
     domain = Column(String(100))
     n_grams = Column(String(100))      # comma-delimited list of n-grams from last_name and email_name
     name_pattern = Column(Integer)     # the name pattern that was used to parse first and last name
+    # normalized keys, computed at ingest time, for looking up candidate matches with an index
+    last_name_key = Column(String(10))      # phonetic (Soundex) code of last_name
+    first_name_key = Column(String(100))    # canonical first_name (e.g. 'robert' for 'bob')
+    first_initial = Column(String(1))       # first letter of first_name
+    canonical_email = Column(String(100))   # email without a '+tag' after the email name
     sim_group_id = Column(Integer, ForeignKey('sim_group.id'), nullable=True)
     similar_people = relationship("Person",
         secondary=sims,
         primaryjoin=id==sims.c.left_person_id,
         secondaryjoin=id==sims.c.right_person_id)
     
+    __table_args__ = (
+        Index('ix_person_name_key', 'last_name_key', 'first_name_key', 'last_name', 'first_name'),
+        Index('ix_person_name', 'last_name', 'first_name'),
+        Index('ix_person_initial', 'last_name_key', 'first_initial'),
+        Index('ix_person_email', 'email'),
+        Index('ix_person_canonical_email', 'canonical_email'),
+        Index('ix_person_domain', 'domain', 'email_name'),
+    )
+
     def __init__(self, source_id, input_record):
-        self.source_person_id = source_id
-        self.input_record = input_record
-        self.first_name, self.last_name, self.name_pattern = get_firstname_lastname(self.input_record)
-        self.email, self.email_name, self.domain = get_email_name_domain(self.input_record)
-        self.n_grams = (','.join(
-            get_n_grams(self.last_name) | 
-            get_n_grams(self.email_name)))
+        # the same parsing as the bulk insert path in run_process.py (see parse_person)
+        for column, value in parse_person(source_id, input_record).items():
+            setattr(self, column, value)
 
     def __repr__(self):
         return 'person object: {}'.format(self.input_record)
 
 
+def get_typo_conditions(first_name):
+    """
+    Returns the conditions on the people whose first names could be typos of a first
+    name (within MAX_FIRST_NAME_DISTANCE): a length within the distance, and for a single
+    edit, the same first_initial (looked up with the (last_name_key, first_initial) index)
+    unless the edit is at the start of the name.
+    """
+    length = len(first_name)
+    same_length = func.length(Person.first_name).between(
+        max(MIN_FUZZY_NAME_LENGTH, length - MAX_FIRST_NAME_DISTANCE), length + MAX_FIRST_NAME_DISTANCE)
+    if MAX_FIRST_NAME_DISTANCE > 1:
+        return [same_length]
+    edits_at_start = or_(
+        Person.first_name.in_([first_name[1:], first_name[1:2] + first_name[:1] + first_name[2:]]),
+        func.substr(Person.first_name, 2).in_([first_name[1:], first_name]))
+    return [same_length, or_(Person.first_initial == first_name[:1], edits_at_start)]
+
+
+def get_candidates(session, person):
+    """
+    Returns a query for the people that could be similar to a person (any object with
+    the Person attributes, e.g. a new record parsed with parse_person), using index
+    lookups instead of scanning all people: the same canonical email, or a last name
+    that sounds the same and the same canonical first name or one that could be a typo
+    of it (see get_typo_conditions). This is a superset of the people that
+    get_sim_score() can score at 50 or more.
+    """
+    conditions = []
+    if person.canonical_email:
+        conditions.append(Person.canonical_email == person.canonical_email)
+    if person.last_name:
+        if person.last_name_key:
+            same_last_name = Person.last_name_key == person.last_name_key
+        else:
+            # no letters to make a phonetic code from (e.g. digits only)
+            same_last_name = Person.last_name == person.last_name
+        first_names = [Person.first_name_key == person.first_name_key]
+        if len(person.first_name or '') >= MIN_FUZZY_NAME_LENGTH:
+            first_names.append(and_(*get_typo_conditions(person.first_name)))
+        conditions.append(and_(same_last_name, or_(*first_names)))
+    query = session.query(Person).filter(or_(*conditions) if conditions else false())
+    if getattr(person, 'id', None) is not None:
+        query = query.filter(Person.id != person.id)
+    return query
+
+
 class Sim_group(Base):
     """
     A sim_group contains a set of people that likely represent the same human person due to their 
@@ -62,13 +119,73 @@ class Sim_group(Base):
     is_misc = Column(Boolean, default=False, server_default="false")
     # bi-directional one-to-many (e.g. person.sim_group and sim_group.people)
     people = relationship("Person", order_by="Person.id", backref="sim_group")
+    # the canonical representation of this person (aka "title"), their most frequent email,
+    # and the number of people in the group (see grouping.save_canonical_records)
+    canonical_name = Column(String(100))
+    canonical_email = Column(String(100))
+    size = Column(Integer)
+    # an id that doesn't change between runs as long as the group's smallest source_person_id
+    # doesn't (see grouping.get_stable_id)
+    stable_id = Column(Integer)
     # other attributes to add in the future...
-    # the canonical representation of this person (aka "title")
-    # canonical_name = Column(String(100))
     # flag for whether a human reviewer has confirmed the group is correct and complete
     # reviewed = Column(Boolean, default=False, server_default="false")  
 
 
+class Run_state(Base):
+    """
+    Records the progress of each stage (step) of a run, so that an interrupted run
+    can be resumed without redoing completed work. Stages that commit their work
+    in blocks (e.g. step 2) record the last block committed.
+    """
+    __tablename__ = 'run_state'
+    stage = Column(String(50), primary_key=True)
+    completed = Column(Boolean, default=False, server_default="false")
+    last_block = Column(Integer, nullable=True)   # last block committed, for stages done in blocks
+    count = Column(Integer, nullable=True)        # the number of records created by the stage so far
+
+    def __repr__(self):
+        return 'run_state object: {} completed={} last_block={}'.format(
+            self.stage, self.completed, self.last_block)
+
+
+class Input_stamp(Base):
+    """
+    The size and modification time of the input file whose people were loaded into the
+    database (by step 1), so that a resumed run can tell whether the file has changed.
+    """
+    __tablename__ = 'input_stamp'
+    id = Column(Integer, primary_key=True)
+    input_size = Column(Integer)
+    input_mtime = Column(Integer)                 # seconds since the epoch
+
+    def __repr__(self):
+        return 'input_stamp object: size={} mtime={}'.format(self.input_size, self.input_mtime)
+
+
+def get_run_state(session, stage):
+    "Returns the Run_state for a stage, adding a new one to the session if it doesn't exist yet."
+    state = session.query(Run_state).get(stage)
+    if state is None:
+        state = Run_state(stage=stage, completed=False)
+        session.add(state)
+    return state
+
+
+# Columns of the covering index used to write the report in order without a sort.
+# It is created after grouping, so it isn't maintained during inserts and updates.
+REPORT_ORDER_INDEX = 'ix_person_report_order'
+REPORT_ORDER_INDEX_COLUMNS = ['sim_group_id DESC', 'last_name', 'first_name', 'id',
+                              'source_person_id', 'input_record', 'email', 'domain']
+
+
+def create_report_order_index(session):
+    "Creates the covering index for writing the report (sim_group_id DESC, last_name, first_name)."
+    session.execute('CREATE INDEX IF NOT EXISTS {} ON person ({})'.format(
+        REPORT_ORDER_INDEX, ', '.join(REPORT_ORDER_INDEX_COLUMNS)))
+    session.commit()
+
+
 def make_sim_group_1(session):
     "Manually create default sim_group id=1 when database is first created."
     g = Sim_group(id=1, is_misc=True)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: nicknames.py
+"""
+Common English nicknames and spelling variants of first names, used to
+give people a canonical first name (e.g. 'bob' and 'rob' --> 'robert').
+Where a nickname is shared by several names it is listed under the most
+common one only.
+"""
+
+# canonical first name --> nicknames and variant spellings
+NICKNAMES = {
+    'alexander': ['alex', 'xander', 'sandy'],
+    'andrew': ['andy', 'drew'],
+    'anne': ['ann', 'annie', 'anna'],
+    'anthony': ['tony'],
+    'benjamin': ['ben', 'benny', 'benji'],
+    'catherine': ['cathy', 'cate', 'cat'],
+    'charles': ['charlie', 'chuck', 'chas'],
+    'christopher': ['chris', 'kit', 'topher'],
+    'daniel': ['dan', 'danny'],
+    'david': ['dave', 'davey', 'davy'],
+    'deborah': ['deb', 'debbie', 'debra'],
+    'donald': ['don', 'donnie'],
+    'edward': ['ed', 'eddie', 'ted', 'ned'],
+    'elizabeth': ['liz', 'lizzie', 'beth', 'betty', 'betsy', 'eliza'],
+    'gerald': ['gerry', 'jerry'],
+    'gregory': ['greg'],
+    'james': ['jim', 'jimmy', 'jamie'],
+    'jeffrey': ['jeff', 'geoffrey', 'geoff'],
+    'jennifer': ['jen', 'jenny', 'jenn'],
+    'john': ['jon', 'johnny', 'jack'],
+    'jonathan': ['jonny'],
+    'joseph': ['joe', 'joey'],
+    'katherine': ['kate', 'kathy', 'katie', 'kat', 'kathryn'],
+    'kenneth': ['ken', 'kenny'],
+    'lawrence': ['larry', 'laurence'],
+    'margaret': ['maggie', 'meg', 'peggy', 'marge'],
+    'matthew': ['matt'],
+    'michael': ['mike', 'mikey', 'mick'],
+    'nicholas': ['nick', 'nicky'],
+    'patricia': ['pat', 'patty', 'trish'],
+    'peter': ['pete'],
+    'rebecca': ['becky', 'becca'],
+    'richard': ['rick', 'ricky', 'rich', 'dick'],
+    'robert': ['bob', 'bobby', 'rob', 'robbie', 'bert'],
+    'ronald': ['ron', 'ronnie'],
+    'samuel': ['sam', 'sammy'],
+    'stephen': ['steve', 'steven', 'stevie'],
+    'susan': ['sue', 'susie', 'suzanne'],
+    'thomas': ['tom', 'tommy'],
+    'timothy': ['tim', 'timmy'],
+    'william': ['bill', 'billy', 'will', 'willie', 'liam'],
+}
+
+# nickname --> canonical first name
+CANONICAL_FIRST_NAMES = dict(
+    (nickname, name) for name, nicknames in NICKNAMES.items() for nickname in nicknames)
@@ -5,10 +5,41 @@
 """
  Each of the regex patterns used in parsing attributes from a person record:
  firstname, lastname, email address, email name, email domain.
+ Patterns are compiled lazily, on first use, to keep start-up time low.
 """
 import re
-
-pattern_names_1 = re.compile(
+import string
+
+
+class LazyPattern(object):
+    """
+    A regex pattern that is compiled the first time it is used, so importing
+    this module stays cheap. After the first use the compiled pattern's methods
+    are bound directly on the instance, so there is no per-call overhead.
+    """
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def compile(self):
+        "Compiles the pattern (if needed) and returns the compiled regex object."
+        compiled = self.__dict__.get('_compiled')
+        if compiled is None:
+            compiled = re.compile(self.pattern, self.flags)
+            self._compiled = compiled
+            self.match = compiled.match
+            self.search = compiled.search
+            self.sub = compiled.sub
+        return compiled
+
+    def __getattr__(self, name):
+        # only called for attributes not yet bound on the instance
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.compile(), name)
+
+
+pattern_names_1 = LazyPattern(
     # looks for lastname, firstname [other stuff] 
     # handles names with hyphens or spaces
     # must have comma (lastname, firstname)
@@ -23,7 +54,7 @@ pattern_names_1 = re.compile(
     """,
     re.UNICODE | re.VERBOSE)
 
-pattern_names_2 = re.compile(
+pattern_names_2 = LazyPattern(
     # looks for "firstname lastname [other stuff]" (between quotes)
     # handles names with hyphens or spaces
     # must NOT have comma (firstname [space] lastname)
@@ -36,7 +67,7 @@ pattern_names_2 = re.compile(
     """,
     re.UNICODE | re.VERBOSE)
 
-pattern_names_3 = re.compile(
+pattern_names_3 = LazyPattern(
     # looks for firstname lastname <email@domain.tld> (no quotes)
     r"""
     [\"\']?                   # optional leading single or double quote
@@ -48,7 +79,7 @@ pattern_names_3 = re.compile(
     """,
     re.UNICODE | re.VERBOSE)
 
-pattern_names_4 = re.compile(
+pattern_names_4 = LazyPattern(
     # looks for first.i.last@domain.tld
     r"""
     (?P<first>[\w\-]+)         # first name
@@ -61,7 +92,7 @@ pattern_names_4 = re.compile(
     re.UNICODE | re.VERBOSE)
 
 
-pattern_names_5 = re.compile(
+pattern_names_5 = LazyPattern(
     # looks for firstname lastname [other stuff]
     r"""
     [\"\']?                   # optional quote char (must be escaped in re.VERBOSE mode)
@@ -74,7 +105,7 @@ pattern_names_5 = re.compile(
     re.UNICODE | re.VERBOSE)
 
 
-pattern_names_6 = re.compile(
+pattern_names_6 = LazyPattern(
     # looks for firstname lastname [other stuff], optionally with a middle initial
     r"""
     (?P<first>\w+)            # first name
@@ -85,7 +116,7 @@ pattern_names_6 = re.compile(
     re.UNICODE | re.VERBOSE)
 
 
-pattern_names_7 = re.compile(
+pattern_names_7 = LazyPattern(
     # looks for firstname.lastname@domain.tld
     # where separator must exist and can be dot or underscore
     # only works when email is at the beginnng of the line (when matching)
@@ -101,7 +132,7 @@ pattern_names_7 = re.compile(
     re.UNICODE | re.VERBOSE)
 
 
-pattern_names_8 = re.compile(
+pattern_names_8 = LazyPattern(
     # Here we are searching within a string to find the email address containing a
     # dot or underscore which presumably separates first and last names
    r"""
@@ -114,6 +145,29 @@ pattern_names_8 = re.compile(
     """,
     re.UNICODE | re.VERBOSE)
 
+# Guards: linear-time patterns for conditions that a record must meet to match a
+# pattern, checked first so the pattern never runs on records it can't match (on which
+# its overlapping [\w\s]+ and \s{1,2} quantifiers backtrack in quadratic time or worse).
+# Python's re has no atomic groups or possessive quantifiers to do this in the patterns.
+
+pattern_names_3_guard = LazyPattern(
+    # pattern_names_3 consumes only [\w\s] characters (after an optional quote) up to the
+    # start of the email, so the first other character must be '<' or '(' after whitespace
+    r"""
+    [\"\']?                   # optional leading single or double quote
+    [\w\s]*                   # names and spaces (a single run, with nothing to backtrack into)
+    \s                        # space before the email
+    [<(]                      # start of the email address
+    """,
+    re.UNICODE | re.VERBOSE)
+
+email_name_run = LazyPattern(
+    # pattern_names_8 matches only [\w\-.] characters before its '@', so its match starts after
+    # the last other character (use .match with start and end positions: the .* backtracks
+    # from the end, so it takes linear time)
+    r'.*[^\w\-.]',
+    re.UNICODE | re.DOTALL)
+
 name_patterns = [
     pattern_names_1, 
     pattern_names_2, 
@@ -125,7 +179,7 @@ name_patterns = [
     pattern_names_8,
 ]
 
-pattern_email_name = re.compile(
+pattern_email_name = LazyPattern(
     # gets email name from biglongname@domain.tld (where there is no separator in name)
     # use a re.search on this one, not re.match
     # note this returns the '<' if present, which must be stripped in a containing function
@@ -136,7 +190,7 @@ pattern_email_name = re.compile(
     """,
     re.UNICODE | re.VERBOSE)
 
-pattern_domain = re.compile(
+pattern_domain = LazyPattern(
     # gets domain name from biglongname@domain.tld
     # use a re.search on this one, not re.match
     # note this returns the '>' if present, which must be stripped in a containing function
@@ -148,7 +202,7 @@ pattern_domain = re.compile(
     """,
     re.UNICODE | re.VERBOSE)
 
-pattern_email = re.compile(
+pattern_email = LazyPattern(
     # gets email address from a person record
     # use a re.search on this one, not re.match
     # note this returns the () or <> or [] if present, which must be stripped in a containing function
@@ -156,3 +210,16 @@ pattern_email = re.compile(
     (?P<email>\S+@\S+\.\S+)   # email (must contain exactly one @ followed by text and then at least one . and no whitespace)
     """,
     re.UNICODE | re.VERBOSE)
+
+token = LazyPattern(
+    # the rest of a token, up to the next whitespace (use .match with a start position)
+    r'\S*',
+    re.UNICODE)
+
+whitespace = LazyPattern(
+    # any whitespace character (used when building n-grams)
+    '[%s]' % re.escape(string.whitespace))
+
+punctuation = LazyPattern(
+    # any punctuation character (used when building n-grams)
+    '[%s]' % re.escape(string.punctuation))
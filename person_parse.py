@@ -7,25 +7,38 @@ Defines some utility functions for parsing people records, and calculating
 similarity scores for pairs of people records based on their features.
 """
 
-import re
-import codecs       # to handle unicode characters in input file
 import patterns     # my module containing all the regex patterns
 import string
+import unicodedata
+import functools
+from nicknames import CANONICAL_FIRST_NAMES
 
-whitespace = re.compile('[%s]' % re.escape(string.whitespace))
-punctuation = re.compile('[%s]' % re.escape(string.punctuation))
+MAX_CACHE_SIZE = 100000     # max distinct values cached by a memoized function before it starts over
+MAX_FIRST_NAME_DISTANCE = 1 # first names within this edit distance are treated as typos of each other
+MAX_LAST_NAME_DISTANCE = 2  # last names that sound the same must also be within this edit distance
+MIN_FUZZY_NAME_LENGTH = 4   # first names shorter than this must match exactly (or as nicknames)
+MAX_NAME_RECORD_LENGTH = 500    # longer records (pasted signatures, HTML) aren't parsed for names
 
+edit_distance_cache = {}    # (name, name, max distance) --> bounded edit distance
 
-def get_firstname_lastname(record):
-    "Returns (firstname, lastname,pattern_number) for a given person record"
+# Soundex digit for each consonant; vowels and h, w, y have no digit
+soundex_digits = dict(
+    [(c, '1') for c in 'bfpv'] + [(c, '2') for c in 'cgjkqsxz'] + [(c, '3') for c in 'dt'] +
+    [('l', '4')] + [(c, '5') for c in 'mn'] + [('r', '6')])
+
+
+def get_firstname_lastname(record, max_length=MAX_NAME_RECORD_LENGTH):
+    """
+    Returns (firstname, lastname,pattern_number) for a given person record.
+    Records longer than max_length aren't parsed; the patterns run in linear time
+    (see match_name_pattern), so this bounds the time to parse a record.
+    """
     firstname, lastname = "", ""
     pattern_number = -1  # the value indicating no match found!
+    if max_length and len(record) > max_length:
+        return (firstname, lastname, pattern_number)
     for p in patterns.name_patterns:
-        if p == patterns.pattern_names_8:
-            # Special case where we search instead of match
-            match_object = p.search(record)
-        else:
-            match_object = p.match(record)
+        match_object = match_name_pattern(p, record)
         if match_object:
             firstname = match_object.group('first').strip().lower()
             lastname = match_object.group('last').strip().lower()
@@ -34,8 +47,124 @@ def get_firstname_lastname(record):
     return (firstname, lastname, pattern_number)
 
 
+def match_name_pattern(p, record):
+    """
+    Returns the match object of a name pattern for a record, or None. Patterns that
+    can backtrack super-linearly are only run when a linear pre-check passes.
+    """
+    if p is patterns.pattern_names_1:
+        return p.match(record) if ',' in record else None
+    elif p is patterns.pattern_names_3:
+        return p.match(record) if patterns.pattern_names_3_guard.match(record) else None
+    elif p is patterns.pattern_names_8:
+        # Special case where we search instead of match
+        return search_email_names(p, record)
+    return p.match(record)
+
+
+def search_email_names(p, record):
+    """
+    Returns the first match of pattern_names_8 (first[._][middle.]last@) in a record, or
+    None, like p.search(record) but in linear time. A match ends at an '@' after a word
+    character, and before it has only [\w\-.] characters with at most two dots, so it can
+    only start where the run of those characters before the '@' starts or just after one
+    of its last three dots. Those starts are checked in order (see is_email_name()),
+    rather than searching from every position of the record.
+    """
+    run_start = 0                           # the run can't start before the last '@'
+    at = record.find('@', 1)
+    while at != -1:
+        if record[at - 1].isalnum() or record[at - 1] == '_':
+            run = patterns.email_name_run.match(record, run_start, at)
+            if run:
+                run_start = run.end()
+            dots = []
+            dot = record.rfind('.', run_start, at)
+            while dot != -1 and len(dots) < 3:
+                dots.append(dot)
+                dot = record.rfind('.', run_start, dot)
+            starts = ([run_start] if len(dots) < 3 else []) + [dot + 1 for dot in reversed(dots)]
+            for start in starts:
+                if is_email_name(record[start:at]):
+                    return p.match(record, start, at + 1)
+        run_start = at + 1
+        at = record.find('@', at + 1)
+    return None
+
+
+def is_email_name(name):
+    """
+    Returns True if pattern_names_8 matches all of an email name of [\w\-.] characters
+    (first[._][middle.]last), with string operations rather than the pattern, which
+    backtracks in quadratic time over the '_' signs of a name with a '-' near its end.
+    """
+    parts = name.split('.')
+    if len(parts) == 1:                     # first_last: an '_' after the last '-', inside the name
+        return name.find('_', max(name.rfind('-') + 1, 1), len(name) - 1) != -1
+    return len(parts) <= 3 and all(parts) and not any('-' in part for part in parts[1:])
+
+
 def get_email_name_domain(record):
-    "Returns (email, name, domain) from a given person record"
+    """
+    Returns (email, name, domain) from a given person record, in a single scan outward
+    from the '@' signs (with the same results as the regex version, get_email_name_domain_regex):
+    * name - the part before the last '@' of the first token with an '@' after its first character
+    * email - the first token with an '@' after its first character, then at least one
+      character and a '.' followed by at least one character
+    * domain - the part after the last '@' that is followed by a non-whitespace character
+      (in the first line that has one)
+    """
+    email, name = "", ""
+    last_at = record.rfind('@')
+    if last_at == -1:
+        return (email, name, "")
+
+    at = record.find('@', 1)
+    token_end = 0                           # end of the last token expanded
+    found_name = False
+    while at != -1:
+        if record[at - 1].isspace():        # '@' at the start of a token
+            at = record.find('@', at + 1)
+            continue
+        # expand from the '@' to the whitespace on either side, looking back no further
+        # than the last token, so a record with many '@' signs is scanned in linear time
+        head = record[token_end:at].rsplit(None, 1)[-1].lower()
+        tail = patterns.token.match(record, at).group().lower()
+        token_end = at + len(tail)
+        tail_last_at = tail.rindex('@')
+        if not found_name:
+            found_name = True
+            name = (head + tail[:tail_last_at]).lstrip('<("')
+        if tail.rfind('.', 2, len(tail) - 1) != -1:
+            email = (head + tail).strip(string.punctuation)
+            if at + tail_last_at == last_at and tail_last_at < len(tail) - 1 and '\n' not in record:
+                # the usual case: the domain is the end of the email token
+                return (email, name, tail[tail_last_at + 1:].rstrip('>)"'))
+            break
+        at = record.find('@', token_end)
+
+    if '\n' in record:
+        lines = (get_domain(line, line.rfind('@')) for line in record.split('\n'))
+        domain = next((line_domain for line_domain in lines if line_domain is not None), None)
+    else:
+        domain = get_domain(record, last_at)
+    return (email, name, domain or "")
+
+
+def get_domain(line, at):
+    """
+    Returns the domain after the last '@' (at or before position at) that is followed by
+    a non-whitespace character in a line, or None if there's no such '@'.
+    """
+    while at != -1:
+        if at + 1 < len(line) and not line[at + 1].isspace():
+            return line[at + 1:].split(None, 1)[0].rstrip('>)"').lower()
+        at = line.rfind('@', 0, at)
+    return None
+
+
+def get_email_name_domain_regex(record):
+    "Returns (email, name, domain) from a given person record (reference version, with three regexes)"
     email, name, domain = "", "", ""
     name_match_object = patterns.pattern_email_name.search(record)
     if name_match_object:
@@ -52,14 +181,167 @@ def get_email_name_domain(record):
     return (email, name, domain)
 
 
+def memoize(f):
+    """
+    Decorator that caches the results of a function of one argument, so that a
+    key is computed once per distinct name rather than once per record.
+    """
+    cache = {}
+
+    @functools.wraps(f)
+    def memoized(arg):
+        try:
+            return cache[arg]
+        except KeyError:
+            if len(cache) >= MAX_CACHE_SIZE:
+                cache.clear()
+            result = cache[arg] = f(arg)
+            return result
+    memoized.cache = cache
+    return memoized
+
+
+def parse_person(source_id, record):
+    """
+    Returns a dict of the Person attributes (column name --> value) parsed from
+    a person record, e.g. for inserting rows without creating Person objects.
+    """
+    first_name, last_name, name_pattern = get_firstname_lastname(record)
+    email, email_name, domain = get_email_name_domain(record)
+    return {
+        'source_person_id': source_id,
+        'input_record': record,
+        'first_name': first_name,
+        'last_name': last_name,
+        'name_pattern': name_pattern,
+        'email': email,
+        'email_name': email_name,
+        'domain': domain,
+        'n_grams': ','.join(get_n_grams(last_name) | get_n_grams(email_name)),
+        'last_name_key': get_soundex(last_name),
+        'first_name_key': get_first_name_key(first_name),
+        'first_initial': first_name[:1],
+        'canonical_email': get_canonical_email(email),
+    }
+
+
+@memoize
+def get_soundex(name):
+    """
+    Returns the Soundex code of a name (e.g. 'smith' and 'smyth' are both 's530'),
+    or '' if the name has no letters. Accented letters are treated as unaccented.
+    """
+    name = unicodedata.normalize('NFKD', unicode(name)).encode('ascii', 'ignore').lower()
+    letters = [c for c in name if c in string.ascii_lowercase]
+    if not letters:
+        return ''
+    code = [letters[0]]
+    previous = soundex_digits.get(letters[0])
+    for c in letters[1:]:
+        digit = soundex_digits.get(c)
+        if digit and digit != previous:
+            code.append(digit)
+        if c not in 'hw':           # h and w don't separate letters with the same digit
+            previous = digit
+    return (''.join(code) + '000')[:4]
+
+
+@memoize
+def get_first_name_key(first_name):
+    """
+    Returns the canonical form of a first name, so that nicknames and variant
+    spellings get the same key (e.g. 'bob' --> 'robert').
+    """
+    return CANONICAL_FIRST_NAMES.get(first_name, first_name)
+
+
+@memoize
+def get_deletion_variants(name):
+    """
+    Returns the name and every string made by deleting one character from it. Two
+    names within an edit distance of 1 always share at least one of these variants.
+    """
+    return tuple(set([name] + [name[:i] + name[i + 1:] for i in range(len(name))]))
+
+
+def get_edit_distance(a, b, max_distance):
+    """
+    Returns the Damerau-Levenshtein distance (optimal string alignment: insertions,
+    deletions, substitutions and transpositions of adjacent characters) between two
+    strings, or max_distance + 1 if it is more than max_distance. Results are cached
+    per distinct pair of strings.
+    """
+    if a == b:
+        return 0
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1     # at least this many insertions or deletions are needed
+    if a > b:
+        a, b = b, a                 # the distance is symmetric; order the pair for the cache
+    key = (a, b, max_distance)
+    try:
+        return edit_distance_cache[key]
+    except KeyError:
+        if len(edit_distance_cache) >= MAX_CACHE_SIZE:
+            edit_distance_cache.clear()
+        distance = edit_distance_cache[key] = get_bounded_edit_distance(a, b, max_distance)
+        return distance
+
+
+def get_bounded_edit_distance(a, b, max_distance):
+    """
+    Computes the distance for get_edit_distance() with a banded dynamic program: only
+    cells within max_distance of the diagonal can be within the bound, so only those
+    are computed, and it stops as soon as every cell in a row is over the bound.
+    """
+    over = max_distance + 1
+    len_b = len(b)
+    previous_row = None
+    row = [j if j <= max_distance else over for j in range(len_b + 1)]
+    for i in range(1, len(a) + 1):
+        new_row = [over] * (len_b + 1)
+        if i <= max_distance:
+            new_row[0] = i
+        row_min = new_row[0]
+        for j in range(max(1, i - max_distance), min(len_b, i + max_distance) + 1):
+            d = min(row[j] + 1,                                 # deletion
+                    new_row[j - 1] + 1,                         # insertion
+                    row[j - 1] + (a[i - 1] != b[j - 1]))        # substitution (or match)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                d = min(d, previous_row[j - 2] + 1)             # transposition
+            new_row[j] = d if d < over else over
+            if d < row_min:
+                row_min = d
+        if row_min >= over:
+            return over                 # no alignment can get back within the bound
+        previous_row, row = row, new_row
+    return row[len_b]
+
+
+def is_first_name_typo(a, b):
+    "Returns True if two (different, non-blank) first names are close enough to be typos of each other."
+    return (min(len(a), len(b)) >= MIN_FUZZY_NAME_LENGTH and
+            get_edit_distance(a, b, MAX_FIRST_NAME_DISTANCE) <= MAX_FIRST_NAME_DISTANCE)
+
+
+def get_canonical_email(email):
+    """
+    Returns the canonical form of an email address, used for looking up people
+    with the same mailbox: lowercase, without a '+tag' after the email name.
+    """
+    name, at, domain = email.lower().partition('@')
+    if not at:
+        return name
+    return u'{}@{}'.format(name.split('+', 1)[0] or name, domain)
+
+
 def get_n_grams(s, n=3):
     """
     Returns a *set* (not a list) of n_grams (letter sequences) parsed from 
     an input string.
     """
     n_grams_list = []
-    s = re.sub(punctuation, "", s)     # remove punctuation
-    s = re.sub(whitespace, "", s)      # remove whitespace
+    s = patterns.punctuation.sub("", s)   # remove punctuation
+    s = patterns.whitespace.sub("", s)    # remove whitespace
     s = s.lower()                               # lowercase
     pos = 0
     while pos < (len(s) - (n-1)):
@@ -86,6 +368,16 @@ def get_jaccard_index(set_a, set_b):
         return 0
 
 
+def get_signature(person):
+    """
+    Returns a tuple of every attribute of a person that get_sim_score() reads, so that
+    people with the same signature always get the same scores and need only be scored
+    once. Must be kept in step with get_sim_score().
+    """
+    return (person.email, person.last_name, person.first_name,
+            person.last_name_key, person.first_name_key, person.n_grams)
+
+
 def get_sim_score(a, b):
     "Returns a similarity score 0-100 for two person objects and b."
     score = 0
@@ -97,8 +389,23 @@ def get_sim_score(a, b):
         # either last_name is blank --> no basis for a score
         score = 0
     elif a.last_name != b.last_name:
-        # different (non-blank) last names --> not a match
-        score = 0
+        if (a.last_name_key and a.last_name_key == b.last_name_key and a.first_name and b.first_name and
+                (a.first_name_key == b.first_name_key or is_first_name_typo(a.first_name, b.first_name)) and
+                get_edit_distance(a.last_name, b.last_name, MAX_LAST_NAME_DISTANCE) <= MAX_LAST_NAME_DISTANCE):
+            # last names that sound the same and are spelled similarly, and the same
+            # (or nickname, or mistyped) first names --> possible match
+            score = 60
+        else:
+            # different (non-blank) last names --> not a match
+            score = 0
+    elif (a.last_name == b.last_name) and a.first_name and b.first_name and \
+            (a.first_name != b.first_name) and (a.first_name_key == b.first_name_key):
+        # Identical lastnames and first names that are nicknames of the same name --> likely match
+        score = 70
+    elif (a.last_name == b.last_name) and a.first_name and b.first_name and \
+            (a.first_name != b.first_name) and is_first_name_typo(a.first_name, b.first_name):
+        # Identical lastnames and a typo in the first name --> likely match
+        score = 65
     elif (a.last_name == b.last_name) and (a.first_name != b.first_name):
         # Identical lastnames but different first names --> unlikely match
         # Avoid using n_grams in this case to avoid false positives
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: progress.py
+"""
+Reports the progress of long running steps: every PROGRESS_INTERVAL seconds a
+line with the count done, the rate per second and, when the total is known, the
+percentage done and an ETA is written to stderr, and the same figures to an
+optional heartbeat file (JSON, replaced atomically) for monitoring.
+
+Updates only add to a counter: the clock is read when the count reaches the
+next check point, which is spaced to come a few times per interval, so the
+overhead on the loops that report progress is negligible. Steps shorter than
+the interval print nothing.
+"""
+
+import json
+import os, sys
+import time
+
+PROGRESS_INTERVAL = 10.0    # seconds between progress reports (0 to report nothing to stderr)
+CHECKS_PER_INTERVAL = 10    # aim to read the clock this many times per interval
+FIRST_CHECK = 100           # count at which the clock is first read
+
+settings = {
+    'interval': PROGRESS_INTERVAL,
+    'heartbeat_file': None,
+    'label': None,          # e.g. the input file, to tell apart the progress of runs sharing stderr
+}
+
+
+def configure(interval=PROGRESS_INTERVAL, heartbeat_file=None, label=None):
+    "Sets how progress is reported by the Progress objects created from now on."
+    settings.update(interval=interval, heartbeat_file=heartbeat_file, label=label)
+
+
+def format_duration(seconds):
+    "Returns a duration as h:mm:ss."
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+
+
+def write_heartbeat(file_name, heartbeat):
+    "Replaces the heartbeat file with a dict as JSON, so a reader never sees it half written."
+    temp_file_name = file_name + '.tmp'
+    with open(temp_file_name, 'w') as f:
+        json.dump(heartbeat, f, sort_keys=True)
+    try:
+        os.rename(temp_file_name, file_name)
+    except OSError:     # on Windows, rename doesn't replace an existing file
+        os.remove(file_name)
+        os.rename(temp_file_name, file_name)
+
+
+class Progress(object):
+    """
+    The progress of a step, counting units (e.g. 'records') out of total if it is
+    known. Call update(n) as units are done, and finish() at the end.
+    """
+    def __init__(self, step, unit, total=None):
+        self.step = step
+        self.unit = unit
+        self.total = total
+        self.count = 0
+        self.interval = settings['interval']
+        self.heartbeat_file = settings['heartbeat_file']
+        self.label = settings['label']
+        self.start_time = self.check_time = self.report_time = time.time()
+        self.check_count = 0
+        self.reported = False
+        self.enabled = self.interval > 0 or self.heartbeat_file
+        self.next_check = FIRST_CHECK if self.enabled else float('inf')
+        if self.heartbeat_file:
+            self.write_heartbeat(self.start_time)
+
+    def update(self, n=1):
+        "Adds n units done."
+        self.count += n
+        if self.count >= self.next_check:
+            self.check()
+
+    def check(self):
+        "Reports progress if the interval has passed, and sets the next check point."
+        now = time.time()
+        interval = self.interval or PROGRESS_INTERVAL
+        if now - self.report_time >= interval:
+            self.report(now)
+        rate = (self.count - self.check_count) / max(now - self.check_time, 1e-6)
+        self.check_count, self.check_time = self.count, now
+        self.next_check = self.count + max(1, int(rate * interval / CHECKS_PER_INTERVAL))
+
+    def get_heartbeat(self, now, done=False):
+        "Returns a dict of the progress figures."
+        elapsed = now - self.start_time
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        heartbeat = {'step': self.step, 'unit': self.unit, 'count': self.count, 'total': self.total,
+                     'rate': round(rate, 1), 'elapsed_seconds': round(elapsed, 1), 'percent': None,
+                     'eta_seconds': None, 'done': done, 'time': round(now, 1), 'pid': os.getpid(),
+                     'label': self.label}
+        if self.total:
+            # totals may be estimates, so a step is never shown as done before it is
+            heartbeat['percent'] = 100.0 if done else round(min(99.9, 100.0 * self.count / self.total), 1)
+            if rate and not done:
+                heartbeat['eta_seconds'] = round(max(0, self.total - self.count) / rate, 1)
+        return heartbeat
+
+    def format_line(self, heartbeat):
+        "Returns a progress line, e.g. 'step_2: 1,200,000 of 5,000,000 pairs (24.0%), 40,000 pairs/s, ETA 0:01:35'."
+        line = '{}{}: {:,}'.format(self.label + ' ' if self.label else '', self.step, self.count)
+        if self.total:
+            line += ' of {:,}'.format(self.total)
+        line += ' {}'.format(self.unit)
+        if heartbeat['percent'] is not None:
+            line += ' ({}%)'.format(heartbeat['percent'])
+        line += ', {:,.0f} {}/s'.format(heartbeat['rate'], self.unit)
+        if heartbeat['eta_seconds'] is not None:
+            line += ', ETA {}'.format(format_duration(heartbeat['eta_seconds']))
+        elif heartbeat['done']:
+            line += ', done in {}'.format(format_duration(heartbeat['elapsed_seconds']))
+        return line
+
+    def report(self, now, done=False):
+        heartbeat = self.get_heartbeat(now, done)
+        if self.interval > 0:
+            sys.stderr.write(self.format_line(heartbeat) + '\n')
+            sys.stderr.flush()
+            self.reported = True
+        if self.heartbeat_file:
+            self.write_heartbeat(now, done)
+        self.report_time = now
+
+    def write_heartbeat(self, now, done=False):
+        write_heartbeat(self.heartbeat_file, self.get_heartbeat(now, done))
+
+    def finish(self):
+        "Reports the step as done: on stderr if its progress was reported, and in the heartbeat file."
+        if self.reported:
+            self.report(time.time(), done=True)
+        elif self.heartbeat_file:
+            self.write_heartbeat(time.time(), done=True)
@@ -2,184 +2,764 @@
 # -*- coding: utf-8 -*-
 # module: run_process.py
 """
-Reads people records from an input file, identifies and groups records 
+Reads people records from an input file, identifies and groups records
 that likely represent the same real-world pesron.
 
 Run from command line, passing name of input file as an argument, e.g.
 #> python run_process.py input_file.txt <enter>
+
+The heavy imports (SQLAlchemy and the models module) are deferred until a
+step needs them, so the module can be imported cheaply (e.g. by a scheduler
+or a batch runner) and main() called once per input file.
 """
 
-import codecs
-from person_parse import get_sim_score, same_group, same_names
-import sqlalchemy
-from sqlalchemy.sql import select
-import models
 import os, sys
+import time
 
-# check for correct usage and print error message if incorrect.
-if len(sys.argv) != 2:
-    print """Error. Pass the name of the input file as an argument, e.g. 
-#> python run_process.py input_file.csv <enter>"""
-    sys.exit()
-
-INPUT_FILE = sys.argv[1]                        # full name with extension
 HEADER_ROW = True                               # first row of input file contains field names?
 ENCODING = 'utf-16'                             # 'utf-8', 'latin-1', or 'utf-16' when saved Excel as unicode.txt
-INPUT_FILE_NAME = INPUT_FILE.split('.')[0]      # first part of filename only
-DB_NAME = '{}.sqlite'.format(INPUT_FILE_NAME)
-OUTPUT_FILE_NAME = '{}_output.txt'.format(INPUT_FILE_NAME)
 SCORE_THRESHOLD = 50                            # scores above this level are possible matches
 MEASURE_EXEC_TIME = True                        # for measuring and printing execution time
 DELIMETER = '\t'
+SCORE_BLOCK_SIZE = 1000                         # signatures scored per committed (resumable) block in step 2
+INSERT_BATCH_SIZE = 1000                        # people rows inserted per executemany in step 1
+BYTES_PER_RECORD = 50                           # input file bytes per record, to size the dedup Bloom filter (low = safe)
+COMPRESSION_RATIO = 10                          # uncompressed bytes per byte of a compressed input file (high = safe)
 
-print 'INPUT_FILE: {}'.format(INPUT_FILE)
-print 'DB_NAME: {}'.format(DB_NAME)
-print 'OUTPUT_FILE_NAME: {}'.format(OUTPUT_FILE_NAME)
+USAGE = """Pass the name of the input file as an argument, e.g.
+#> python run_process.py input_file.csv <enter>"""
 
-if MEASURE_EXEC_TIME:
-    import time
-    start_time = time.time()
 
-# ** Step 0 **
-# Recreate the db file from scratch each time
-try: 
-    os.remove(DB_NAME)
-    print 'Database {} dropped.'.format(DB_NAME)
-except IOError:
-    print 'No database file found.'
+def get_db_name(input_file):
+    "Returns the name of the SQLite database file for a given input file."
+    input_file_name = input_file.split('.')[0]  # first part of filename only
+    return '{}.sqlite'.format(input_file_name)
+
+
+def get_output_file_name(input_file, compress=None):
+    """
+    Returns the name of the output report file for a given input file, with the
+    extension of a compression ('gz', 'bz2', 'xz' or 'zst') if it is compressed.
+    """
+    from compressed_io import add_compression
+
+    input_file_name = input_file.split('.')[0]  # first part of filename only
+    return add_compression('{}_output.txt'.format(input_file_name), compress)
+
+
+def step_0_create_db(db_name, resume=False, input_file=None):
+    """
+    Recreates the db file from scratch and returns a new session bound to it.
+    If resuming, an existing db file is kept so completed stages can be skipped,
+    unless its people were loaded from another version of input_file (if given).
+    """
+    import sqlalchemy
+    import sqlalchemy.orm
+    import models
+
+    if resume and os.path.exists(db_name):
+        engine = sqlalchemy.create_engine('sqlite:///{}'.format(db_name))
+        models.Base.metadata.create_all(engine)     # creates any missing tables only
+        models.Base.metadata.bind = engine
+        session = sqlalchemy.orm.sessionmaker(bind=engine)()
+        if not (input_file and is_input_changed(session, input_file)):
+            print 'Database {} opened to resume the run.'.format(db_name)
+            return session
+        print '{} has changed since it was loaded into {}; loading it again.'.format(input_file, db_name)
+        session.close()
+        engine.dispose()
+
+    try:
+        os.remove(db_name)
+        print 'Database {} dropped.'.format(db_name)
+    except OSError:
+        print 'No database file found.'
+
+    engine = sqlalchemy.create_engine('sqlite:///{}'.format(db_name))
+    models.Base.metadata.create_all(engine)
+
+    # set up the db connection
+    models.Base.metadata.bind = engine
+    DBSession = sqlalchemy.orm.sessionmaker(bind=engine)
+    session = DBSession()
+
+    models.make_sim_group_1(session)  # create default sim_group 1
+    print 'Database {} created.'.format(db_name)
+    return session
+
+
+def read_input_records(input_file, encoding=ENCODING, header_row=HEADER_ROW):
+    """
+    Yields (source_id, record) from a two-column, tab-delimited input file, with
+    the record stripped of surrounding whitespace. The file may be compressed (see
+    compressed_io.py).
+    Note: updated to work with two-column input file on 4/21/15
+    """
+    from compressed_io import open_text
+
+    with open_text(input_file, mode="r", encoding=encoding) as f:
+        if header_row:
+            # skip first line in input file
+            next(f)
+        for row in f:
+            row = row.split(DELIMETER)
+            source_id = row[0]  # the source ID for the record
+            record = row[1].strip()
+            yield source_id, record
+
+
+def get_input_stamp(input_file):
+    "Returns (size, modification time) of an input file, which change when the file is changed."
+    stat = os.stat(input_file)
+    return stat.st_size, int(stat.st_mtime)
+
+
+def save_input_stamp(session, input_file):
+    "Records the stamp of the input file loaded into a database (in the input_stamp table)."
+    import models
+
+    stamp = session.query(models.Input_stamp).first()
+    if stamp is None:
+        stamp = models.Input_stamp()
+        session.add(stamp)
+    stamp.input_size, stamp.input_mtime = get_input_stamp(input_file)
+
+
+def is_input_changed(session, input_file):
+    """
+    Returns True if the people in a database were loaded from an input file that has
+    changed since (or from a version that wasn't recorded), False if they weren't loaded.
+    """
+    import models
+
+    if not get_stage_state(session, 'step_1').completed:
+        return False
+    stamp = session.query(models.Input_stamp).first()
+    return stamp is None or (stamp.input_size, stamp.input_mtime) != get_input_stamp(input_file)
 
-engine = sqlalchemy.create_engine('sqlite:///{}'.format(DB_NAME))
-models.Base.metadata.create_all(engine)
 
-# set up the db connection
-models.Base.metadata.bind = engine
-DBSession = sqlalchemy.orm.sessionmaker(bind=engine)
-session = DBSession()
+def step_1_load_people(session, input_file, encoding=ENCODING, header_row=HEADER_ROW, dedup='hash'):
+    """
+    Reads people records from the input file, parses them into people rows,
+    and inserts them in batches (bypassing the ORM unit of work). Records
+    duplicated in the input file are skipped (see dedup.py): dedup is 'hash'
+    (a table of 64-bit hashes) or 'bloom' (a Bloom filter), either confirmed
+    on the input_record index. Duplicate counts are written to a file. The
+    input file's stamp is recorded (see get_input_stamp). Returns the number of
+    people created.
+    """
+    from sqlalchemy.sql import select
+    from person_parse import parse_person
+    from dedup import Deduplicator, get_duplicates_file_name, write_duplicates
+    from progress import Progress
+    import models
 
-models.make_sim_group_1(session)  # create default sim_group 1
-print 'Database {} created.'.format(DB_NAME)
+    person = models.Person.__table__
+    insert_person = person.insert()
+    rows = []
+    pending_records = set()     # records of the batch not inserted yet
 
+    def is_loaded(record):
+        return record in pending_records or session.execute(
+            select([person.c.id]).where(person.c.input_record == record)).first() is not None
 
-# ** Step 1 **
-# Read people records from the input file, instantiate Person objects,
-# and save them to the database.
-# Note: updated to work with two-column input file on 4/21/15
-with codecs.open(INPUT_FILE, mode="r", encoding=ENCODING) as f:
+    bloom_capacity = None
+    if dedup == 'bloom':
+        from compressed_io import get_compression
+        input_size = os.path.getsize(input_file) * (COMPRESSION_RATIO if get_compression(input_file) else 1)
+        bloom_capacity = input_size // BYTES_PER_RECORD + 1
+    deduplicator = Deduplicator(is_loaded, bloom_capacity)
+    save_input_stamp(session, input_file)
+    progress = Progress('step_1', 'records')
     count_input_records = 0
-    records_processed = dict()  # prevents adding the same record twice if duplicated in INPUT_FILE
-    if HEADER_ROW:
-        # skip first line in input file
-        next(f)
-    for row in f:
-        row = row.split('\t')
-        source_id = row[0]  # the source ID for the record
-        record = row[1].strip()
-        if record and not record in records_processed:
-            records_processed[record] = 1
-            p = models.Person(source_id, record)
-            session.add(p)
+    for source_id, record in read_input_records(input_file, encoding, header_row):
+        progress.update()
+        if record and not deduplicator.is_duplicate(record):
+            rows.append(parse_person(source_id, record))
+            pending_records.add(record)
             count_input_records += 1
-session.commit()
-print '{} people records created.'.format(count_input_records)
-
-
-# ** Step 2 **
-# Create sims relationships - this is an O(n^2) algorithm!
-count_sims_records = 0
-people_recordset = session.query(models.Person).all()
-for a_person in people_recordset:
-    for b_person in people_recordset:
-        if a_person.id != b_person.id:  # don't score a record against itself
-            score = get_sim_score(a_person, b_person)
-            if score >= SCORE_THRESHOLD:
-                # create a sim record by adding b_person to a_person's 'similar_people' attribute
-                a_person.similar_people.append(b_person)
-                count_sims_records += 1
-session.commit()
-print '{} sims records created.'.format(count_sims_records)
-
-
-# ** Step 3 **
-# Arrange people records into groups based on sims relationships.
-# Records with no sims go into the misc sim_group 1.
-people = session.query(models.Person).all()
-for person in people:
-    if person.sim_group_id:             # person has already been grouped
-        continue                        # skip immediately to the next person
-    else:
-        sims = person.similar_people
-        if not sims:                    # person has no sims
-            person.sim_group_id = 1     # put person in misc group
-            session.add(person)
-        else:                           # put person and his sims into a new group
-            related_people = [person]
-            related_people.extend(sims)
-            new_group = models.Sim_group(people=related_people)
-            session.add(new_group)
-        session.flush()                 # flush session each time (needed?)
-session.commit()
-
-
-# ** Step 3a **
-# At this stage there can be a person in a group by himself.
-# Those cases should either be moved to another group, or to group 1 (misc).
-# 1. Get a list of people alone in a group
-people_alone_in_a_group = select([models.Person.id]).\
-        group_by(models.Person.sim_group_id).\
-        having(sqlalchemy.func.count(models.Person.id) == 1)
-
-single_grouped_people = session.query(models.Person).\
-        filter(models.Person.id.in_(people_alone_in_a_group)).\
-        all()
-
-for p in single_grouped_people: # for each person alone in a group...
-    old_group_id = p.sim_group_id  # the old group to be deleted
-    same_grp = same_group(p.similar_people) # an int representing the same group_id, or False
-    #  if (all sims are in the same group) AND (all sims have the same first and last name):
-    if same_grp and same_names(p.similar_people):
-        p.sim_group_id = same_grp  # put this person in the same group as his sims
+            if len(rows) >= INSERT_BATCH_SIZE:
+                session.execute(insert_person, rows)
+                rows = []
+                pending_records.clear()
+    if rows:
+        session.execute(insert_person, rows)
+    progress.finish()
+    print '{} people records created.'.format(count_input_records)
+    if deduplicator.count_duplicates:
+        duplicates_file_name = get_duplicates_file_name(input_file)
+        write_duplicates(deduplicator, duplicates_file_name, encoding)
+        print '{} duplicate records skipped ({} distinct); counts written to {}.'.format(
+            deduplicator.count_duplicates, len(deduplicator.duplicates), duplicates_file_name)
+    return count_input_records
+
+
+def load_signatures(session, score_threshold, block_size_cap=None):
+    """
+    Loads people and collapses those with the same signature (the attributes the score
+    depends on). Returns the list of lists of people per signature, and a blocking plan
+    for scoring them (see blocking.py).
+    """
+    from sqlalchemy.sql import select
+    from blocking import plan_blocks, group_by_signature
+    import models
+
+    # plain rows rather than ORM objects: they aren't expired by each block's commit
+    people_recordset = session.execute(
+        select([models.Person.__table__]).order_by(models.Person.id)).fetchall()
+    signatures = group_by_signature(people_recordset)
+    print '{} people have {} distinct signatures.'.format(len(people_recordset), len(signatures))
+    plan = plan_blocks([people[0] for people in signatures], score_threshold, block_size_cap=block_size_cap)
+    for line in plan.report:
+        print line
+    return signatures, plan
+
+
+def get_neighbours(signatures, engine, score_threshold):
+    """
+    Returns the TF-IDF neighbours of each signature (see tfidf.py) for the 'tfidf' engine,
+    or None for the rule based engine.
+    """
+    if engine != 'tfidf':
+        return None
+    from tfidf import get_neighbours as get_tfidf_neighbours
+
+    neighbours = get_tfidf_neighbours([people[0] for people in signatures],
+                                      min_similarity=score_threshold / 100.0)
+    print '{} TF-IDF neighbour pairs found.'.format(sum(len(similar) for similar in neighbours))
+    return neighbours
+
+
+def get_pairs_progress(signatures, plan, neighbours=None, start=0):
+    """
+    Returns a Progress counting the pairs scored in step 2, out of an estimate of the
+    total: the comparisons in the blocking plan (an upper bound) and the TF-IDF
+    neighbours, pro rata to the signatures left when resuming from signature start.
+    """
+    from progress import Progress
+
+    total = plan.count_comparisons() + (sum(len(similar) for similar in neighbours) if neighbours else 0)
+    if start and signatures:
+        total = total * (len(signatures) - start) // len(signatures)
+    return Progress('step_2', 'pairs', total)
+
+
+def score_signatures(signatures, plan, score_threshold, start=0, stop=None, neighbours=None, progress=None):
+    """
+    Scores each signature from signatures[start:stop] against the signatures sharing a
+    blocking key with it. Yields (signature number, list of similar signature numbers),
+    where a signature is similar to itself if its people are sims of each other.
+    If neighbours (from get_neighbours) are given, each signature is also scored
+    against its TF-IDF neighbours, and scores may be raised by their similarity.
+    The pairs scored are counted on progress, if given.
+    """
+    from person_parse import get_sim_score
+
+    signature_number = dict((people[0].id, i) for i, people in enumerate(signatures))
+    for i in range(start, len(signatures) if stop is None else min(stop, len(signatures))):
+        a_signature = signatures[i][0]
+        similar_signatures = []
+        if get_sim_score(a_signature, a_signature) >= score_threshold:
+            similar_signatures.append(i)
+        if neighbours is None:
+            candidates = plan.get_candidates(a_signature)
+            for b_signature in candidates:
+                if get_sim_score(a_signature, b_signature) >= score_threshold:
+                    similar_signatures.append(signature_number[b_signature.id])
+        else:
+            from tfidf import get_tfidf_score
+            candidates = dict((signature_number[b_signature.id], 0.0)
+                              for b_signature in plan.get_candidates(a_signature))
+            candidates.update(neighbours[i])
+            for j in sorted(candidates):
+                if get_tfidf_score(a_signature, signatures[j][0], candidates[j]) >= score_threshold:
+                    similar_signatures.append(j)
+        if progress is not None:
+            progress.update(len(candidates))
+        yield i, similar_signatures
+
+
+def step_2_create_sims(session, score_threshold=SCORE_THRESHOLD, block_size=SCORE_BLOCK_SIZE,
+                       block_size_cap=None, engine='rules'):
+    """
+    Creates sims relationships in the sims table. People with the same signature are
+    scored once, and each signature is only scored against the signatures sharing a
+    blocking key with it. This finds the same sims as scoring every pair of people,
+    unless block_size_cap approximates it by capping blocks. Signatures are scored in
+    blocks of block_size, and each block's sims are committed together with the block
+    number, so an interrupted run can resume from the last committed block. With the
+    'tfidf' engine, signatures are also scored against their TF-IDF neighbours. Returns
+    the number of sims records created.
+    """
+    import models
+
+    state = models.get_run_state(session, 'step_2')
+    count_sims_records = state.count or 0
+    first_block = 0 if state.last_block is None else state.last_block + 1
+    if first_block:
+        print 'Resuming step 2 at block {} ({} sims records already created).'.format(
+            first_block, count_sims_records)
+
+    signatures, plan = load_signatures(session, score_threshold, block_size_cap)
+    neighbours = get_neighbours(signatures, engine, score_threshold)
+    progress = get_pairs_progress(signatures, plan, neighbours, first_block * block_size)
+    for block_start in range(first_block * block_size, len(signatures), block_size):
+        sims_rows = []
+        for i, similar_signatures in score_signatures(signatures, plan, score_threshold, block_start,
+                                                      block_start + block_size, neighbours, progress):
+            similar_people = [b_person for j in similar_signatures for b_person in signatures[j]]
+            for a_person in signatures[i]:
+                for b_person in similar_people:
+                    if a_person.id != b_person.id:  # a person isn't a sim of themself
+                        # create a sim record from a_person to b_person
+                        sims_rows.append({'left_person_id': a_person.id, 'right_person_id': b_person.id})
+        if sims_rows:
+            session.execute(models.sims.insert(), sims_rows)
+        count_sims_records += len(sims_rows)
+        state.last_block = block_start // block_size
+        state.count = count_sims_records
+        session.commit()
+    progress.finish()
+    print '{} sims records created.'.format(count_sims_records)
+    return count_sims_records
+
+
+def step_2_create_sims_graph(session, score_threshold=SCORE_THRESHOLD, block_size_cap=None,
+                             sims_file=None, spanning_sims=False, engine='rules'):
+    """
+    Creates sims relationships like step_2_create_sims(), but keeps them in memory as a
+    compact graph over signatures (see sim_graph.py) instead of the sims table. The graph
+    is saved to sims_file if given. If spanning_sims is True, a spanning set of sims (one
+    fewer than the people in each connected set) is saved to the sims table. Returns
+    (the number of sims the graph represents, the graph).
+    """
+    from sim_graph import SimGraph
+    import models
+
+    signatures, plan = load_signatures(session, score_threshold, block_size_cap)
+    neighbours = get_neighbours(signatures, engine, score_threshold)
+    progress = get_pairs_progress(signatures, plan, neighbours)
+    sims = [similar_signatures for _, similar_signatures in
+            score_signatures(signatures, plan, score_threshold, neighbours=neighbours, progress=progress)]
+    progress.finish()
+    graph = SimGraph.from_lists([[person.id for person in people] for people in signatures], sims)
+    count_sims_records = graph.count_sims()
+    print '{} sims found ({} between signatures).'.format(count_sims_records, len(graph.sim_indices))
+    if sims_file:
+        graph.save(sims_file)
+        print 'Sims graph saved to {}.'.format(sims_file)
+    if spanning_sims:
+        sims_rows = [{'left_person_id': a, 'right_person_id': b} for a, b in graph.get_spanning_sims()]
+        if sims_rows:
+            session.execute(models.sims.insert(), sims_rows)
+        print '{} spanning sims records created.'.format(len(sims_rows))
+    return count_sims_records, graph
+
+
+def get_sims_from_table(session):
+    """
+    Returns a function returning the ids of a person's sims, from the sims table. The
+    sims are streamed in person id order (the order of the table's primary key) as
+    they are asked for, so asking for people in id order, as steps 3 and 3a do, reads
+    the table once without holding it in memory: only one person's sims are kept.
+    Asking for an earlier person starts reading the table again.
+    """
+    from itertools import groupby
+    from sqlalchemy.sql import select
+    import models
+
+    def read_sims():
+        rows = session.execute(select([models.sims.c.left_person_id, models.sims.c.right_person_id]).
+                               order_by(models.sims.c.left_person_id, models.sims.c.right_person_id))
+        for left_person_id, person_rows in groupby(rows, lambda row: row[0]):
+            yield left_person_id, [right_person_id for _, right_person_id in person_rows]
+
+    # [sims stream, the last person id asked for, (left person id, their sims) read last]
+    state = [None, None, (None, [])]
+
+    def get_similar(person_id):
+        if state[0] is None or person_id < state[1]:
+            state[0], state[2] = read_sims(), (None, [])
+        state[1] = person_id
+        left_person_id, similar_people = state[2]
+        while left_person_id is None or left_person_id < person_id:
+            left_person_id, similar_people = state[2] = next(state[0], (float('inf'), []))
+        return similar_people if left_person_id == person_id else []
+    return get_similar
+
+
+def get_scores_from_db(session):
+    """
+    Returns a function returning the scores of a person with each of a list of people,
+    loading the attributes scored from the database as they are needed (only for the
+    people split out of oversized groups).
+    """
+    from sqlalchemy.sql import select
+    from person_parse import get_sim_score
+    import models
+
+    person = models.Person.__table__
+    columns = [person.c.id, person.c.email, person.c.last_name, person.c.first_name,
+               person.c.last_name_key, person.c.first_name_key, person.c.n_grams]
+    people = {}
+
+    def get_scores(person_id, other_ids):
+        missing = [i for i in [person_id] + list(other_ids) if i not in people]
+        for start in range(0, len(missing), 500):     # within SQLite's limit of bound parameters
+            for row in session.execute(select(columns).where(person.c.id.in_(missing[start:start + 500]))):
+                people[row.id] = row
+        a = people[person_id]
+        return [get_sim_score(a, people[other_id]) for other_id in other_ids]
+    return get_scores
+
+
+def step_3_create_groups(session, graph=None, max_group_size=None):
+    """
+    Arranges people records into groups based on sims relationships (steps 3 and
+    3a, see grouping.py), from the sims graph if given, otherwise from the sims
+    table. Records with no sims go into the misc sim_group 1. If max_group_size is
+    given, larger groups are split, keeping each person's best scoring sims. Then
+    each group's canonical name, canonical email and size are computed (step 3b).
+    Returns the number of groups.
+    """
+    from sqlalchemy.sql import select
+    from grouping import assign_groups, save_groups, save_canonical_records
+    from progress import Progress
+    import models
+
+    person = models.Person.__table__
+    names = {}
+    person_ids = []
+    for person_id, first_name, last_name in session.execute(
+            select([person.c.id, person.c.first_name, person.c.last_name]).order_by(person.c.id)):
+        person_ids.append(person_id)
+        names[person_id] = (first_name, last_name)
+    get_similar = graph.get_similar if graph is not None else get_sims_from_table(session)
+
+    progress = Progress('step_3', 'people', len(person_ids))
+    split_people = []
+    group_of, groups = assign_groups(person_ids, get_similar, names, progress=progress,
+                                     max_group_size=max_group_size, get_scores=get_scores_from_db(session),
+                                     split_people=split_people)
+    progress.finish()
+    save_groups(session, group_of, groups)
+    print '{} new groups created.'.format(len(groups))
+    if split_people:
+        print '{} people split from groups of more than {} people.'.format(len(split_people), max_group_size)
+
+    # ** Step 3b **
+    # Compute each group's canonical record in one pass over the people, ordered by group.
+    save_canonical_records(session)
+    return len(groups)
+
+
+def report_sort_key(row):
+    "Sort key for report rows: sim_group_id DESC, last_name, first_name (then id, for ties)."
+    return (row[2] is None, -(row[2] or 0), row[4], row[3], row[7])
+
+
+def get_report_rows(session, memory_budget=None):
+    """
+    Returns an iterator over report rows ordered by sim_group_id DESC, last_name,
+    first_name. With no memory budget, a covering index is created after grouping
+    and SQLite streams the rows in index order. With a memory budget (in bytes),
+    rows are read in table order and sorted with a chunked external merge sort
+    that spills to temp files whenever the budget is exceeded.
+    """
+    from sqlalchemy.sql import select
+    import models
+
+    p = models.Person.__table__
+    g = models.Sim_group.__table__
+    columns = [p.c.source_person_id, p.c.input_record, p.c.sim_group_id, p.c.first_name,
+               p.c.last_name, p.c.email, p.c.domain, p.c.id,
+               g.c.size, g.c.canonical_name, g.c.canonical_email, g.c.stable_id]
+    people_groups = p.outerjoin(g, p.c.sim_group_id == g.c.id)
+    if memory_budget is None:
+        models.create_report_order_index(session)
+        query = select(columns).select_from(people_groups).\
+            order_by(p.c.sim_group_id.desc(), p.c.last_name, p.c.first_name, p.c.id)
+        return iter(session.execute(query))
     else:
-        p.sim_group_id = 1  # put him in the misc group
-    # either way, delete the now empty group from the groups table
-    old_group = session.query(models.Sim_group).filter_by(id=old_group_id).one()
-    session.delete(old_group)
-
-group_count = session.query(sqlalchemy.func.count(models.Sim_group.id)).scalar()
-print '{} new groups created.'.format(group_count)
-session.commit()
-
-
-## ** Step 4 **
-## Write output file - pipe-delimited
-people_recordset = session.query(models.Person).\
-    order_by(models.Person.sim_group_id.desc(), models.Person.last_name, models.Person.first_name).all()
-
-with codecs.open(OUTPUT_FILE_NAME, mode="w", encoding=ENCODING) as outfile:
-    # write header row
-    outfile.write(u'person_id{D}input_record{D}sim_group_id{D}first_name{D}last_name{D}email{D}domain{D}full_name\n'.format(D=DELIMETER))
-
-    for person in people_recordset:
-        kwargs = {
-          'D': DELIMETER,
-          'source_person_id': person.source_person_id,
-          'input_record': person.input_record, 
-          'sim_group_id': person.sim_group_id, 
-          'first_name': person.first_name, 
-          'last_name': person.last_name, 
-          'email': person.email,
-          'domain': person.domain,
-          'full_name': u'{}, {}'.format(person.last_name, person.first_name).title() if (person.first_name and person.last_name) else u''
-        }
-        line = u'{source_person_id}{D}{input_record}{D}{sim_group_id}{D}{first_name}{D}{last_name}{D}{email}{D}{domain}{D}{full_name}\n'.format(**kwargs)
-        outfile.write(line)
-
-session.close()
-if MEASURE_EXEC_TIME:
-    end_time = time.time()
-    exec_time = end_time - start_time
+        from external_sort import external_sort
+        rows = session.execute(select(columns).select_from(people_groups).order_by(p.c.id))
+        return external_sort(rows, report_sort_key, memory_budget)
+
+
+def step_4_write_report(session, output_file_name, encoding=ENCODING, memory_budget=None, stable_ids=False):
+    """
+    Writes the output file - tab-delimited, and compressed if its extension says so.
+    If stable_ids is True, the sim_group_id column has the groups' stable ids (see
+    grouping.get_stable_id) instead of their ids in the database.
+    """
+    from sqlalchemy.sql import select, func
+    from compressed_io import open_text
+    from progress import Progress
+    import models
+
+    progress = Progress('step_4', 'rows', session.execute(
+        select([func.count()]).select_from(models.Person.__table__)).scalar())
+    people_recordset = get_report_rows(session, memory_budget)
+
+    with open_text(output_file_name, mode="w", encoding=encoding) as outfile:
+        # write header row
+        outfile.write(u'person_id{D}input_record{D}sim_group_id{D}first_name{D}last_name{D}email{D}domain{D}full_name{D}group_size{D}canonical_name{D}canonical_email\n'.format(D=DELIMETER))
+
+        for source_person_id, input_record, sim_group_id, first_name, last_name, email, domain, _, \
+                group_size, canonical_name, canonical_email, stable_id in people_recordset:
+            kwargs = {
+              'D': DELIMETER,
+              'source_person_id': source_person_id,
+              'input_record': input_record,
+              'sim_group_id': stable_id if stable_ids else sim_group_id,
+              'first_name': first_name,
+              'last_name': last_name,
+              'email': email,
+              'domain': domain,
+              'full_name': u'{}, {}'.format(last_name, first_name).title() if (first_name and last_name) else u'',
+              'group_size': group_size or u'',
+              'canonical_name': canonical_name or u'',
+              'canonical_email': canonical_email or u''
+            }
+            line = u'{source_person_id}{D}{input_record}{D}{sim_group_id}{D}{first_name}{D}{last_name}{D}{email}{D}{domain}{D}{full_name}{D}{group_size}{D}{canonical_name}{D}{canonical_email}\n'.format(**kwargs)
+            outfile.write(line)
+            progress.update()
+    progress.finish()
+
+
+def step_5_write_delta(session, output_file_name, previous_db_name, encoding=ENCODING):
+    """
+    Writes the delta file: the people added, removed or changed since the run whose
+    database was kept as previous_db_name (see delta.py). Returns the number of people
+    in it.
+    """
+    from delta import write_delta
+
+    counts = write_delta(session, previous_db_name, output_file_name, encoding)
+    print '{added} people added, {removed} removed and {changed} changed since the previous run.'.format(**counts)
+    return sum(counts.values())
+
+
+def keep_previous_db(db_name, previous_db_name):
+    "Renames the database of the previous run to previous_db_name (replacing an older one), if there is one."
+    if os.path.exists(db_name):
+        if os.path.exists(previous_db_name):
+            os.remove(previous_db_name)
+        os.rename(db_name, previous_db_name)
+        print 'Database {} kept as {}.'.format(db_name, previous_db_name)
+
+
+def print_exec_time(count_input_records, exec_time):
+    "Prints the execution time in seconds, minutes or hours."
     if exec_time < 60:
         print '\nProcessed {0} records in {1} seconds.'.format(count_input_records, round(exec_time, 2))
     elif exec_time < 3600:
         print '\nProcessed {0} records in {1} minutes.'.format(count_input_records, round(exec_time/60, 2))
     else:
         print '\nProcessed {0} records in {1} hours.'.format(count_input_records, round(exec_time/3600, 2))
+
+
+def run_stage(session, stage, step, *args, **kwargs):
+    """
+    Runs one step of the process as a named stage, unless a resumed run already
+    completed it. The stage's completion is committed in the same transaction as
+    the rest of its work. A step returns its count of records created, or a tuple
+    of (count, other results). Returns what the step returned, or the recorded
+    count if the stage was skipped.
+    """
+    import models
+
+    state = models.get_run_state(session, stage)
+    if state.completed:
+        print '{} already completed ({} records); skipping.'.format(stage, state.count)
+        return state.count
+    session.commit()
+    result = step(session, *args, **kwargs)
+    state = models.get_run_state(session, stage)  # the step may have committed (and expired) it
+    state.completed = True
+    state.count = result[0] if isinstance(result, tuple) else result
+    session.commit()
+    return result
+
+
+def get_stage_state(session, stage):
+    "Returns the Run_state of a stage (see run_stage)."
+    import models
+    return models.get_run_state(session, stage)
+
+
+def process_file(input_file, score_threshold=SCORE_THRESHOLD, memory_budget=None, resume=False,
+                 block_size_cap=None, sims_storage='table', sims_file=None, spanning_sims=False,
+                 dedup='hash', engine='rules', compress=None, progress_interval=None, heartbeat_file=None,
+                 stable_ids=False, delta=False, max_group_size=None):
+    """
+    Runs all the steps for one input file. Returns a dict of metrics for the run:
+    people, sims and groups counts, and the execution time in seconds.
+    memory_budget (bytes) bounds the memory used for ordering the report.
+    If resume is True, an existing database is reused and completed stages skipped
+    (unless the input file has changed since it was loaded).
+    block_size_cap approximates step 2 by capping the size of blocks of people scored.
+    sims_storage is 'table' (the sims table) or 'csr' (a compact graph in memory,
+    optionally saved to sims_file, with only spanning sims saved if spanning_sims).
+    dedup is how step 1 detects duplicate records: 'hash' or 'bloom'.
+    engine is the scoring engine of step 2: 'rules' or 'tfidf' (see tfidf.py).
+    compress is the compression of the report: None, 'gz', 'bz2', 'xz' or 'zst'. The
+    input file is decompressed as its extension says.
+    Progress of the steps is reported to stderr every progress_interval seconds (by
+    default progress.PROGRESS_INTERVAL, 0 for never) and to heartbeat_file, if given.
+    If stable_ids is True, the report has the groups' stable ids (see grouping.py). If
+    delta is True, the previous run's database is kept and the changes since then are
+    written to a delta file (see delta.py).
+    max_group_size bounds the size of groups, splitting larger ones (see grouping.py).
+    """
+    import progress
+
+    progress.configure(progress.PROGRESS_INTERVAL if progress_interval is None else progress_interval,
+                       heartbeat_file, label=os.path.basename(input_file))
+    check_codecs(input_file, compress)
+    db_name = get_db_name(input_file)
+    output_file_name = get_output_file_name(input_file, compress)
+    print 'INPUT_FILE: {}'.format(input_file)
+    print 'DB_NAME: {}'.format(db_name)
+    print 'OUTPUT_FILE_NAME: {}'.format(output_file_name)
+
+    start_time = time.time()
+    if delta:
+        from delta import get_previous_db_name, get_delta_file_name
+        previous_db_name = get_previous_db_name(input_file)
+        if not resume:      # a resumed run's database is this run's, not the previous one
+            keep_previous_db(db_name, previous_db_name)
+    session = step_0_create_db(db_name, resume, input_file)
+    try:
+        count_input_records = run_stage(session, 'step_1', step_1_load_people, input_file, dedup=dedup)
+        graph = None
+        if sims_storage == 'csr':
+            # the graph is only kept in memory (and sims_file), so when resuming after step 2
+            # it is loaded from sims_file, or built again if step 3 still needs it
+            step_2_state = get_stage_state(session, 'step_2')
+            if step_2_state.completed and get_stage_state(session, 'step_3').completed:
+                count_sims_records = step_2_state.count
+            elif step_2_state.completed and sims_file and os.path.exists(sims_file):
+                from sim_graph import SimGraph
+                graph = SimGraph.load(sims_file)
+                count_sims_records = step_2_state.count
+                print 'Sims graph loaded from {}.'.format(sims_file)
+            else:
+                # a completed step 2 committed its spanning sims, so rebuilding the graph mustn't save them again
+                save_spanning_sims = spanning_sims and not step_2_state.completed
+                step_2_state.completed = False
+                count_sims_records, graph = run_stage(
+                    session, 'step_2', step_2_create_sims_graph, score_threshold, block_size_cap=block_size_cap,
+                    sims_file=sims_file, spanning_sims=save_spanning_sims, engine=engine)
+        else:
+            count_sims_records = run_stage(session, 'step_2', step_2_create_sims, score_threshold,
+                                           block_size_cap=block_size_cap, engine=engine)
+        group_count = run_stage(session, 'step_3', step_3_create_groups, graph, max_group_size=max_group_size)
+        run_stage(session, 'step_4', step_4_write_report, output_file_name, memory_budget=memory_budget,
+                  stable_ids=stable_ids)
+        if delta:
+            run_stage(session, 'step_5', step_5_write_delta, get_delta_file_name(input_file, compress),
+                      previous_db_name)
+    finally:
+        # a batch worker runs many files, so a failed one mustn't leave its connection open
+        session.close()
+        session.bind.dispose()
+    exec_time = time.time() - start_time
+
+    return {
+        'input_file': input_file,
+        'people': count_input_records,
+        'sims': count_sims_records,
+        'groups': group_count,
+        'seconds': exec_time,
+    }
+
+
+def check_codecs(input_file, compress=None):
+    """
+    Raises ImportError if the module to decompress the input file or compress the report
+    isn't installed, so a run fails before any work rather than in step 4.
+    """
+    from compressed_io import get_codec, get_compression
+
+    for compression in [get_compression(input_file), compress]:
+        if compression:
+            get_codec(compression)
+
+
+def check_compress_arg(parser, input_file, compress):
+    "Exits with the usage message if --compress or the input file needs a module that isn't installed."
+    try:
+        check_codecs(input_file, compress)
+    except ImportError as e:
+        parser.error(str(e))
+
+
+def parse_args(argv):
+    "Parses command line arguments. Exits with the usage message if they are incorrect."
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Parse and group people records.', usage=USAGE)
+    parser.add_argument('input_file', help='two-column, tab-delimited input file')
+    parser.add_argument('--memory-budget', type=int, metavar='MB',
+        help='sort the report in at most MB megabytes of memory, spilling to temp files '
+             '(default: sort with a covering index in the database)')
+    parser.add_argument('--resume', action='store_true',
+        help='continue an interrupted run from its database, skipping completed stages '
+             'and step 2 blocks (default: start from scratch)')
+    parser.add_argument('--max-block-size', type=int, metavar='N',
+        help='approximate step 2 by splitting blocks of more than N people with lossy keys '
+             'and then into chunks of N (default: exact; only lossless splits)')
+    parser.add_argument('--sims-storage', choices=['table', 'csr'], default='table',
+        help="keep sims in the sims table ('table', the default) or in a compact in-memory "
+             "graph ('csr'), which only saves the groups to the database")
+    parser.add_argument('--sims-file', metavar='FILE',
+        help="with --sims-storage csr, save the sims graph to FILE (.npz needs numpy, any other "
+             "extension is a binary file); a resumed run loads it instead of scoring again")
+    parser.add_argument('--spanning-sims', action='store_true',
+        help='with --sims-storage csr, save a spanning set of sims to the sims table')
+    parser.add_argument('--dedup', choices=['hash', 'bloom'], default='hash',
+        help="detect duplicate records with a table of 64-bit hashes ('hash', the default) or "
+             "a smaller Bloom filter ('bloom'), either confirmed on the input_record index")
+    parser.add_argument('--engine', choices=['rules', 'tfidf'], default='rules',
+        help="score people with the rules only ('rules', the default), or also by the TF-IDF "
+             "cosine similarity of their last name and email name n-grams ('tfidf', needs numpy)")
+    parser.add_argument('--compress', choices=['gz', 'bz2', 'xz', 'zst'],
+        help='compress the report, e.g. to [filename]_output.txt.gz (default: uncompressed). '
+             'Compressed input files are read as their extension says')
+    parser.add_argument('--progress-interval', type=float, metavar='SECONDS',
+        help='report the progress of each step to stderr every SECONDS seconds (default 10, 0 for never)')
+    parser.add_argument('--heartbeat-file', metavar='FILE',
+        help='also write the progress of the current step to FILE, as JSON, for monitoring')
+    parser.add_argument('--stable-ids', action='store_true',
+        help="report each group's stable id (its smallest person_id; 0 for people in no group) "
+             "instead of its sim_group id, which changes from run to run")
+    parser.add_argument('--delta', action='store_true',
+        help='keep the previous run\'s database as [filename]_previous.sqlite and write the people '
+             'added, removed or changed since then to [filename]_delta.txt')
+    parser.add_argument('--max-group-size', type=int, metavar='N',
+        help="split groups of more than N people, keeping each person's best scoring sims "
+             "(default: no limit)")
+    args = parser.parse_args(argv)
+    check_compress_arg(parser, args.input_file, args.compress)
+    return args
+
+
+def main(argv=None):
+    "Command line entry point. Returns a process exit code."
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+
+    metrics = process_file(args.input_file, memory_budget=memory_budget, resume=args.resume,
+                           block_size_cap=args.max_block_size, sims_storage=args.sims_storage,
+                           sims_file=args.sims_file, spanning_sims=args.spanning_sims, dedup=args.dedup,
+                           engine=args.engine, compress=args.compress, progress_interval=args.progress_interval,
+                           heartbeat_file=args.heartbeat_file, stable_ids=args.stable_ids, delta=args.delta,
+                           max_group_size=args.max_group_size)
+    if MEASURE_EXEC_TIME:
+        print_exec_time(metrics['people'], metrics['seconds'])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: shard_process.py
+"""
+Runs the process on inputs too large for one machine by sharding it by
+blocking key. Local worker processes stand in for the nodes of a cluster.
+
+1. partition - writes the input records into N shard files by a hash of their
+   phonetic last name key (or their email, if they have no last name), so
+   all the people who can score as similar by name are in the same shard.
+2. run - runs each shard file on its own, with its own SQLite database and
+   report, on a pool of worker processes.
+3. merge - combines the shard databases into one database with globally
+   unique sim_group_ids, and writes one report. People with the same email in
+   different shards (the only sims that can cross shards) have their groups
+   merged.
+
+Run from command line, passing the step ('partition', 'run', 'merge' or
+'all'), the name of the input file and the number of shards, e.g.
+#> python shard_process.py all input_file.txt --shards 8 <enter>
+"""
+
+import codecs
+import sys
+import zlib
+
+import run_process
+
+USAGE = """Pass the step, the name of the input file and the number of shards, e.g.
+#> python shard_process.py all input_file.txt --shards 8 <enter>"""
+MERGE_BATCH_SIZE = 10000    # people rows inserted per executemany when merging
+
+
+def get_shard_file_names(input_file, shards):
+    "Returns the names of the shard files for an input file (the db and report names derive from them)."
+    input_file_name = input_file.split('.')[0]  # first part of filename only
+    return ['{}_shard{}.txt'.format(input_file_name, i) for i in range(shards)]
+
+
+def get_shard_key(record):
+    """
+    Returns the key a record is sharded by: its phonetic last name key (or the last
+    name as spelled, if it has no letters), or its email if it has no last name.
+    """
+    from person_parse import get_firstname_lastname, get_email_name_domain, get_soundex
+
+    _, last_name, _ = get_firstname_lastname(record)
+    if last_name:
+        return u'name:' + (get_soundex(last_name) or last_name)
+    email, _, _ = get_email_name_domain(record)
+    return u'email:' + (email or record)
+
+
+def get_shard(key, shards):
+    "Returns the shard number for a key. Stable across processes and machines (unlike hash())."
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % shards
+
+
+def partition(input_file, shards):
+    "Writes the records of the input file into shard files. Returns the shard file names."
+    shard_file_names = get_shard_file_names(input_file, shards)
+    shard_files = [codecs.open(name, mode="w", encoding=run_process.ENCODING) for name in shard_file_names]
+    counts = [0] * shards
+    try:
+        for f in shard_files:
+            f.write(u'person_id{}person\n'.format(run_process.DELIMETER))     # header row
+        for source_id, record in run_process.read_input_records(input_file):
+            if not record:
+                continue
+            shard = get_shard(get_shard_key(record), shards)
+            shard_files[shard].write(u'{}{}{}\n'.format(source_id, run_process.DELIMETER, record))
+            counts[shard] += 1
+    finally:
+        for f in shard_files:
+            f.close()
+    print '{} records partitioned into {} shards (largest {}, smallest {}).'.format(
+        sum(counts), shards, max(counts), min(counts))
+    return shard_file_names
+
+
+def run_shard(args):
+    "Runs the process on one shard file (in a worker process). Returns its metrics."
+    shard_file_name, options = args
+    return run_process.process_file(shard_file_name, **options)
+
+
+def run_shards(shard_file_names, processes=None, **options):
+    """
+    Runs the process on each shard file, on a pool of worker processes (one per CPU
+    by default). Keyword options are passed to run_process.process_file(). Returns
+    the list of metrics of each shard.
+    """
+    import multiprocessing
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        metrics = pool.map(run_shard, [(name, options) for name in shard_file_names], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    for m in metrics:
+        print '{input_file}: {people} people, {sims} sims, {groups} groups in {seconds:.2f} seconds'.format(**m)
+    return metrics
+
+
+class UnionFind(object):
+    "Disjoint sets of hashable items, for merging groups across shards."
+    def __init__(self):
+        self.parent = {}
+        self.size = {}      # root --> number of items in its set (if more than one)
+
+    def find(self, item):
+        root = item
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        while item != root:     # path compression
+            self.parent[item], item = root, self.parent.get(item, item)
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[b] = a
+            self.size[a] = self.size.get(a, 1) + self.size.pop(b, 1)
+
+    def count(self, item):
+        "Returns the number of items in the set of an item."
+        return self.size.get(self.find(item), 1)
+
+
+def get_merge_key(shard, person):
+    "Returns the key of a person's group in a shard, or of the person if they are in the misc group."
+    from grouping import MISC_GROUP_ID
+
+    if person.sim_group_id in (MISC_GROUP_ID, None):
+        return (shard, None, person.id)
+    return (shard, person.sim_group_id)
+
+
+def merge(input_file, shard_file_names, memory_budget=None, compress=None, stable_ids=False):
+    """
+    Combines the shard databases into the input file's database, and writes its report
+    (compressed if compress is given, see run_process.get_output_file_name, and with
+    stable group ids if stable_ids is True).
+    Groups are renumbered in shard order, and groups (or misc people) with the same
+    email in different shards are merged. Returns the number of groups.
+    """
+    import sqlalchemy
+    from sqlalchemy.sql import select
+    from grouping import MISC_GROUP_ID, save_canonical_records
+    import models
+
+    person = models.Person.__table__
+    shard_engines = [sqlalchemy.create_engine('sqlite:///{}'.format(run_process.get_db_name(name)))
+                     for name in shard_file_names]
+
+    # 1. merge the groups of people with the same email in different shards. Within a
+    # shard the groups are kept as they are, so only the first group with each email
+    # in each shard is merged.
+    groups = UnionFind()
+    email_groups = {}       # email --> the key of the first group seen with it
+    for shard, engine in enumerate(shard_engines):
+        shard_emails = set()
+        for p in engine.execute(select([person.c.id, person.c.sim_group_id, person.c.email]).
+                                order_by(person.c.id)):
+            if p.email and p.email not in shard_emails:
+                shard_emails.add(p.email)
+                key = get_merge_key(shard, p)
+                groups.union(email_groups.setdefault(p.email, key), key)
+
+    # 2. copy the people into the merged database, with globally unique group ids
+    session = run_process.step_0_create_db(run_process.get_db_name(input_file))
+    columns = [c for c in person.columns if c.name not in ('id', 'sim_group_id')]
+    group_ids = {}          # root group key --> merged group id
+    merged_groups = set([MISC_GROUP_ID])
+    count_people = 0
+    for shard, engine in enumerate(shard_engines):
+        rows = []
+        for p in engine.execute(select([person]).order_by(person.c.id)):
+            key = get_merge_key(shard, p)
+            root = groups.find(key)
+            if key[1] is None and groups.count(key) == 1:
+                group_id = MISC_GROUP_ID    # a misc person with no sims in any shard
+            else:
+                group_id = group_ids.setdefault(root, len(group_ids) + MISC_GROUP_ID + 1)
+                merged_groups.add(group_id)
+            row = dict((c.name, p[c.name]) for c in columns)
+            row['sim_group_id'] = group_id
+            rows.append(row)
+            if len(rows) >= MERGE_BATCH_SIZE:
+                session.execute(person.insert(), rows)
+                rows = []
+            count_people += 1
+        if rows:
+            session.execute(person.insert(), rows)
+    new_groups = [{'id': group_id, 'is_misc': False} for group_id in sorted(merged_groups)
+                  if group_id != MISC_GROUP_ID]
+    if new_groups:
+        session.execute(models.Sim_group.__table__.insert(), new_groups)
+    save_canonical_records(session)    # merged groups have people from several shards
+    session.commit()
+    print '{} people merged from {} shards into {} groups.'.format(
+        count_people, len(shard_file_names), len(merged_groups))
+
+    run_process.step_4_write_report(session, run_process.get_output_file_name(input_file, compress),
+                                    memory_budget=memory_budget, stable_ids=stable_ids)
+    session.close()
+    return len(merged_groups)
+
+
+def parse_args(argv):
+    "Parses command line arguments. Exits with the usage message if they are incorrect."
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Parse and group people records in shards.', usage=USAGE)
+    parser.add_argument('step', choices=['partition', 'run', 'merge', 'all'])
+    parser.add_argument('input_file', help='two-column, tab-delimited input file')
+    parser.add_argument('--shards', type=int, required=True, metavar='N', help='number of shards')
+    parser.add_argument('--processes', type=int, metavar='P',
+        help='number of worker processes for the run step (default: one per CPU)')
+    parser.add_argument('--sims-storage', choices=['table', 'csr'], default='table',
+        help='how each shard stores its sims (see run_process.py)')
+    parser.add_argument('--memory-budget', type=int, metavar='MB',
+        help='sort each report in at most MB megabytes of memory (see run_process.py)')
+    parser.add_argument('--compress', choices=['gz', 'bz2', 'xz', 'zst'],
+        help='compress the merged report (see run_process.py)')
+    parser.add_argument('--stable-ids', action='store_true',
+        help="report each group's stable id (see run_process.py)")
+    parser.add_argument('--max-group-size', type=int, metavar='N',
+        help='split groups of more than N people in each shard (see run_process.py); groups '
+             'merged across shards may be larger')
+    args = parser.parse_args(argv)
+    run_process.check_compress_arg(parser, args.input_file, args.compress)
+    return args
+
+
+def main(argv=None):
+    "Command line entry point. Returns a process exit code."
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+    shard_file_names = get_shard_file_names(args.input_file, args.shards)
+
+    if args.step in ('partition', 'all'):
+        partition(args.input_file, args.shards)
+    if args.step in ('run', 'all'):
+        run_shards(shard_file_names, args.processes, memory_budget=memory_budget,
+                   sims_storage=args.sims_storage, max_group_size=args.max_group_size)
+    if args.step in ('merge', 'all'):
+        merge(args.input_file, shard_file_names, memory_budget, args.compress, args.stable_ids)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: sim_graph.py
+"""
+A compact, in-memory form of the similarity graph from step 2, used instead of
+the sims table when storing sims as 'csr'.
+
+People with the same signature have the same sims, so the graph is stored over
+signatures in compressed sparse row (CSR) form: each signature's people, and
+each signature's similar signatures (including itself, if its people are sims
+of each other). A cluster of k identical people costs k + 1 entries instead of
+the k * (k - 1) rows it takes in the sims table. A person's sims are expanded
+from this on demand.
+
+The graph can be saved to a sidecar file: a .npz file (if numpy is installed)
+or a simple binary file of the arrays for any other extension.
+"""
+
+from array import array
+import struct
+
+ARRAY_TYPE = 'I'            # unsigned 32-bit int for ids and offsets (the same size on every platform)
+ARRAY_NAMES = ['member_indptr', 'member_ids', 'sim_indptr', 'sim_indices']
+BINARY_MAGIC = b'SIMGRAPH'
+
+
+class SimGraph(object):
+    """
+    The sims of people, as two CSR structures over signatures numbered 0..n-1:
+    member_ids[member_indptr[i]:member_indptr[i+1]] are the ids of the people with
+    signature i, in id order, and sim_indices[sim_indptr[i]:sim_indptr[i+1]] are the
+    signatures similar to signature i.
+    """
+    def __init__(self, member_indptr, member_ids, sim_indptr, sim_indices):
+        self.member_indptr = member_indptr
+        self.member_ids = member_ids
+        self.sim_indptr = sim_indptr
+        self.sim_indices = sim_indices
+        self.signature_of = None    # person id --> signature, built on first use
+
+    @classmethod
+    def from_lists(cls, members, sims):
+        """
+        Returns a SimGraph from a list of lists of person ids (one per signature),
+        and a list of lists of similar signature numbers (one per signature).
+        """
+        return cls(*[array(ARRAY_TYPE, values) for values in
+                     to_csr(members) + to_csr(sims)])
+
+    def count_signatures(self):
+        return len(self.member_indptr) - 1
+
+    def get_members(self, signature):
+        "Returns the ids of the people with a signature."
+        return self.member_ids[self.member_indptr[signature]:self.member_indptr[signature + 1]]
+
+    def get_similar_signatures(self, signature):
+        return self.sim_indices[self.sim_indptr[signature]:self.sim_indptr[signature + 1]]
+
+    def get_similar(self, person_id):
+        "Returns a list of the ids of a person's sims."
+        if self.signature_of is None:
+            self.signature_of = dict((person_id, signature)
+                                     for signature in range(self.count_signatures())
+                                     for person_id in self.get_members(signature))
+        similar_people = []
+        for signature in self.get_similar_signatures(self.signature_of[person_id]):
+            similar_people.extend(self.get_members(signature))
+        if similar_people and person_id in similar_people:
+            similar_people.remove(person_id)    # a person isn't a sim of themself
+        return similar_people
+
+    def count_sims(self):
+        "Returns the number of (directed) sims between people that the graph represents."
+        count = 0
+        for signature in range(self.count_signatures()):
+            size = len(self.get_members(signature))
+            for similar_signature in self.get_similar_signatures(signature):
+                if similar_signature == signature:
+                    count += size * (size - 1)
+                else:
+                    count += size * len(self.get_members(similar_signature))
+        return count
+
+    def get_spanning_sims(self):
+        """
+        Yields (left person id, right person id) sims that connect the same people
+        as the full graph, with one sim fewer than the number of people in each
+        connected set: a spanning forest. Every sim yielded is a real sim.
+        """
+        parent = {}
+
+        def find(person_id):
+            root = person_id
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while person_id != root:    # path compression
+                parent[person_id], person_id = root, parent.get(person_id, person_id)
+            return root
+
+        for signature in range(self.count_signatures()):
+            people = self.get_members(signature)
+            for similar_signature in self.get_similar_signatures(signature):
+                # every person with this signature is a sim of every person with the similar
+                # signature, so linking each of them to one of those people spans both
+                if similar_signature == signature:
+                    others = people[:1]
+                else:
+                    others = self.get_members(similar_signature)[:1]
+                for person_id in people:
+                    a, b = find(person_id), find(others[0])
+                    if a != b:
+                        parent[a] = b
+                        yield person_id, others[0]
+
+    def save(self, file_name):
+        "Saves the graph to a sidecar file: .npz (requires numpy) or binary."
+        if file_name.endswith('.npz'):
+            import numpy
+            numpy.savez(file_name, **dict((name, numpy.frombuffer(getattr(self, name), dtype=numpy.uint32))
+                                          for name in ARRAY_NAMES))
+            return
+        with open(file_name, 'wb') as f:
+            f.write(BINARY_MAGIC)
+            f.write(struct.pack('<4q', *[len(getattr(self, name)) for name in ARRAY_NAMES]))
+            for name in ARRAY_NAMES:
+                getattr(self, name).tofile(f)
+
+    @classmethod
+    def load(cls, file_name):
+        "Loads a graph saved with save()."
+        if file_name.endswith('.npz'):
+            import numpy
+            data = numpy.load(file_name)
+            return cls(*[array(ARRAY_TYPE, data[name].tolist()) for name in ARRAY_NAMES])
+        with open(file_name, 'rb') as f:
+            if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                raise ValueError('{} is not a sims graph file.'.format(file_name))
+            lengths = struct.unpack('<4q', f.read(32))
+            arrays = []
+            for length in lengths:
+                values = array(ARRAY_TYPE)
+                values.fromfile(f, length)
+                arrays.append(values)
+        return cls(*arrays)
+
+
+def to_csr(lists):
+    "Returns (indptr, indices) lists for a list of lists."
+    indptr = [0]
+    indices = []
+    for values in lists:
+        indices.extend(values)
+        indptr.append(len(indices))
+    return [indptr, indices]
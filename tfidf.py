@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: tfidf.py
+"""
+An alternative scoring engine for step 2, based on the n-grams of people's last
+names and email names (see get_n_grams in person_parse.py).
+
+Each signature's n-grams are weighted by their inverse document frequency, so
+common n-grams like 'son' count for little, and the cosine similarity of these
+TF-IDF vectors is computed for all pairs at once, as a sparse matrix product in
+chunks of rows. Only the top k neighbours of each signature are kept. It uses
+scipy.sparse if it is installed, otherwise the same product is done with plain
+numpy arrays (numpy is required either way).
+
+A pair's score is the rule based score from get_sim_score(), raised to the
+cosine similarity (as a percentage) when their first names don't conflict.
+"""
+
+TOP_K = 10                  # neighbours kept for each signature
+CHUNK_SIZE = 1000           # rows of the matrix multiplied at a time
+
+
+def get_n_gram_sets(people):
+    "Returns a list of the sets of n-grams of people (stored comma-delimited in n_grams)."
+    return [set(g for g in person.n_grams.split(',') if g) if person.n_grams else set() for person in people]
+
+
+def get_tfidf_matrix(n_gram_sets):
+    """
+    Returns the TF-IDF vectors of sets of n-grams as a sparse matrix in CSR form:
+    (indptr, indices, data, number of columns) numpy arrays, with each row scaled
+    to unit length. The weight of an n-gram is log((1 + rows) / (1 + rows with it)) + 1.
+    """
+    import numpy
+
+    columns = {}
+    indptr, indices = [0], []
+    for n_grams in n_gram_sets:
+        indices.extend(sorted(columns.setdefault(g, len(columns)) for g in n_grams))
+        indptr.append(len(indices))
+    indptr = numpy.array(indptr, dtype=numpy.int64)
+    indices = numpy.array(indices, dtype=numpy.int64)
+    document_frequency = numpy.bincount(indices, minlength=len(columns))
+    idf = numpy.log((1.0 + len(n_gram_sets)) / (1.0 + document_frequency)) + 1.0
+    data = idf[indices]
+    rows = numpy.repeat(numpy.arange(len(n_gram_sets)), numpy.diff(indptr))
+    norms = numpy.sqrt(numpy.bincount(rows, weights=data ** 2, minlength=len(n_gram_sets)))
+    return indptr, indices, data / norms[rows], len(columns)
+
+
+def multiply_chunk_scipy(matrix, transposed, start, stop):
+    "Returns (rows, columns, similarities) of the non-zero products of rows start:stop and all rows."
+    product = matrix[start:stop].dot(transposed).tocoo()
+    return product.row + start, product.col, product.data
+
+
+def multiply_chunk_numpy(indptr, indices, data, postings, start, stop):
+    """
+    Returns (rows, columns, similarities) of the non-zero products of rows start:stop
+    and all rows, from the matrix and its postings (the CSC form: for each column, the
+    rows with a value in it). Each row's values are multiplied by the values in the
+    postings of their columns, and the products are summed per pair of rows.
+    """
+    import numpy
+
+    posting_ptr, posting_rows, posting_data = postings
+    entries = numpy.arange(indptr[start], indptr[stop])
+    if not len(entries):
+        return numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64), numpy.zeros(0)
+    entry_rows = numpy.repeat(numpy.arange(start, stop), numpy.diff(indptr[start:stop + 1]))
+    columns = indices[entries]
+    lengths = posting_ptr[columns + 1] - posting_ptr[columns]
+    # for each entry, the positions of its column's postings
+    offsets = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    positions = numpy.repeat(posting_ptr[columns], lengths) + offsets
+    rows = numpy.repeat(entry_rows, lengths)
+    other_rows = posting_rows[positions]
+    products = numpy.repeat(data[entries], lengths) * posting_data[positions]
+    pairs, inverse = numpy.unique(rows * (len(indptr) - 1) + other_rows, return_inverse=True)
+    return pairs // (len(indptr) - 1), pairs % (len(indptr) - 1), numpy.bincount(inverse, weights=products)
+
+
+def get_postings(indptr, indices, data, count_columns):
+    "Returns the CSC form (column pointers, rows, data) of a CSR matrix."
+    import numpy
+
+    order = numpy.argsort(indices, kind='mergesort')
+    rows = numpy.repeat(numpy.arange(len(indptr) - 1), numpy.diff(indptr))
+    posting_ptr = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(indices, minlength=count_columns))])
+    return posting_ptr.astype(numpy.int64), rows[order], data[order]
+
+
+def select_top_k(rows, columns, similarities, k, min_similarity):
+    """
+    Returns a dict of row --> dict of column --> similarity for the k most similar columns
+    of each row (ties go to the lower column), at or above min_similarity and excluding
+    the row itself.
+    """
+    import numpy
+
+    keep = (rows != columns) & (similarities >= min_similarity) & (similarities > 0)
+    rows, columns, similarities = rows[keep], columns[keep], similarities[keep]
+    order = numpy.lexsort((columns, -similarities, rows))
+    rows, columns, similarities = rows[order], columns[order], similarities[order]
+    starts = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(rows)) + 1]) if len(rows) else rows
+    ranks = numpy.arange(len(rows)) - numpy.repeat(starts, numpy.diff(numpy.append(starts, len(rows))))
+    top = {}
+    for row, column, similarity in zip(*[a[ranks < k].tolist() for a in (rows, columns, similarities)]):
+        top.setdefault(row, {})[column] = similarity
+    return top
+
+
+def get_top_k(n_gram_sets, k=TOP_K, min_similarity=0.0, chunk_size=CHUNK_SIZE, use_scipy=None):
+    """
+    Returns a list of dicts of neighbour --> cosine similarity for each set of n-grams:
+    its top k neighbours at or above min_similarity. Uses scipy.sparse if it is installed
+    (or if use_scipy is True), otherwise numpy only.
+    """
+    indptr, indices, data, count_columns = get_tfidf_matrix(n_gram_sets)
+    count_rows = len(n_gram_sets)
+    if use_scipy is None:
+        try:
+            import scipy.sparse
+            use_scipy = True
+        except ImportError:
+            use_scipy = False
+    if use_scipy:
+        import scipy.sparse
+        matrix = scipy.sparse.csr_matrix((data, indices, indptr), shape=(count_rows, count_columns))
+        transposed = matrix.T.tocsr()
+        multiply_chunk = lambda start, stop: multiply_chunk_scipy(matrix, transposed, start, stop)
+    else:
+        postings = get_postings(indptr, indices, data, count_columns)
+        multiply_chunk = lambda start, stop: multiply_chunk_numpy(indptr, indices, data, postings, start, stop)
+
+    neighbours = [{} for _ in range(count_rows)]
+    for start in range(0, count_rows, chunk_size):
+        top = select_top_k(*multiply_chunk(start, min(start + chunk_size, count_rows)),
+                           k=k, min_similarity=min_similarity)
+        for row, similar in top.items():
+            neighbours[row] = similar
+    return neighbours
+
+
+def get_neighbours(people, k=TOP_K, min_similarity=0.0):
+    """
+    Returns a list of dicts of index --> cosine similarity of the TF-IDF vectors of
+    people's n-grams, for pairs where either person is in the other's top k. The
+    relation is symmetric, so sims found through it are too.
+    """
+    neighbours = get_top_k(get_n_gram_sets(people), k, min_similarity)
+    for i, similar in enumerate(neighbours):
+        for j, similarity in similar.items():
+            neighbours[j].setdefault(i, similarity)
+    return neighbours
+
+
+def have_compatible_first_names(a, b):
+    "Returns True unless both people have first names and they are different names (not nicknames or typos)."
+    from person_parse import is_first_name_typo
+
+    return (not a.first_name or not b.first_name or a.first_name_key == b.first_name_key or
+            is_first_name_typo(a.first_name, b.first_name))
+
+
+def get_tfidf_score(a, b, similarity):
+    """
+    Returns the score for two people given the cosine similarity of their n-grams: the
+    rule based score, or the similarity as a percentage if that's higher and their first
+    names don't conflict (the n-grams don't include first names).
+    """
+    from person_parse import get_sim_score
+
+    score = get_sim_score(a, b)
+    tfidf_score = int(100 * similarity + 1e-9)    # allow for rounding, e.g. 0.99999... --> 100
+    if tfidf_score > score and have_compatible_first_names(a, b):
+        return tfidf_score
+    return score
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# module: threshold_sweep.py
+"""
+Shows what the groups would be for several score thresholds, without running
+the whole process for each one.
+
+The people are loaded into the input file's database (or reused from it), and
+every candidate pair of signatures is scored once, keeping the raw score of the
+pairs scoring at or above a low floor. The scores are saved to a compact
+sidecar file, so later sweeps of the same input skip scoring altogether (the
+database and the scores record the size and modification time of the input file
+they were made from, and are made again if it has changed). Then
+the people are grouped as in step 3 for each threshold, from just the pairs
+scoring at or above it, and the group counts and sizes are reported.
+
+Run from command line, passing the name of the input file and the thresholds, e.g.
+#> python threshold_sweep.py input_file.txt --thresholds 50,60,65,70,80 <enter>
+"""
+
+from array import array
+import os, sys
+import struct
+
+import run_process
+
+USAGE = """Pass the name of the input file and a comma-separated list of thresholds, e.g.
+#> python threshold_sweep.py input_file.txt --thresholds 50,60,65,70,80 <enter>"""
+SCORE_FLOOR = 20            # lowest threshold that can be swept (below this, pairs only share a last name)
+SCORES_MAGIC = b'SIMSCORE'
+SIGNATURE_TYPE = 'I'        # unsigned 32-bit int for signature numbers (the same size on every platform)
+SIZE_BUCKETS = [2, 3, 6, 11, 51, 101]   # lower bounds of the group size ranges reported
+
+
+class ScoredPairs(object):
+    """
+    The raw scores of pairs of signatures scoring at or above score_floor, as three
+    parallel arrays: left[k] and right[k] are signature numbers, and score[k] their score.
+    A signature paired with itself means its people score that against each other.
+    input_stamp is the (size, modification time) of the input file that was scored.
+    """
+    def __init__(self, score_floor, left=None, right=None, score=None, input_stamp=(0, 0)):
+        self.score_floor = score_floor
+        self.input_stamp = tuple(input_stamp)
+        self.left = left if left is not None else array(SIGNATURE_TYPE)
+        self.right = right if right is not None else array(SIGNATURE_TYPE)
+        self.score = score if score is not None else array('B')
+
+    def add(self, a, b, score):
+        self.left.append(a)
+        self.right.append(b)
+        self.score.append(score)
+
+    def __len__(self):
+        return len(self.score)
+
+    def get_sims(self, count_signatures, score_threshold):
+        "Returns a list of lists of the signatures similar to each signature at a threshold."
+        sims = [[] for _ in range(count_signatures)]
+        for a, b, score in zip(self.left, self.right, self.score):
+            if score >= score_threshold:
+                sims[a].append(b)
+        return sims
+
+    def save(self, file_name):
+        "Saves the scores to a binary sidecar file."
+        with open(file_name, 'wb') as f:
+            f.write(SCORES_MAGIC)
+            f.write(struct.pack('<4q', self.score_floor, len(self), *self.input_stamp))
+            self.left.tofile(f)
+            self.right.tofile(f)
+            self.score.tofile(f)
+
+    @classmethod
+    def load(cls, file_name):
+        "Loads scores saved with save()."
+        with open(file_name, 'rb') as f:
+            if f.read(len(SCORES_MAGIC)) != SCORES_MAGIC:
+                raise ValueError('{} is not a sim scores file.'.format(file_name))
+            score_floor, length, size, mtime = struct.unpack('<4q', f.read(32))
+            scored_pairs = cls(score_floor, input_stamp=(size, mtime))
+            scored_pairs.left.fromfile(f, length)
+            scored_pairs.right.fromfile(f, length)
+            scored_pairs.score.fromfile(f, length)
+        return scored_pairs
+
+
+def get_scores_file_name(input_file):
+    "Returns the name of the sim scores sidecar file for an input file."
+    input_file_name = input_file.split('.')[0]  # first part of filename only
+    return '{}_scores.bin'.format(input_file_name)
+
+
+def score_pairs(signatures, plan, score_floor, input_stamp=(0, 0)):
+    """
+    Scores each signature against itself and the signatures sharing a blocking key with
+    it (like run_process.score_signatures). Returns the ScoredPairs at or above score_floor.
+    """
+    from person_parse import get_sim_score
+
+    signature_number = dict((people[0].id, i) for i, people in enumerate(signatures))
+    scored_pairs = ScoredPairs(score_floor, input_stamp=input_stamp)
+    for i, people in enumerate(signatures):
+        a_signature = people[0]
+        score = get_sim_score(a_signature, a_signature)
+        if score >= score_floor:
+            scored_pairs.add(i, i, score)
+        for b_signature in plan.get_candidates(a_signature):
+            score = get_sim_score(a_signature, b_signature)
+            if score >= score_floor:
+                scored_pairs.add(i, signature_number[b_signature.id], score)
+    return scored_pairs
+
+
+def get_group_sizes(group_of):
+    "Returns (misc group size, list of the sizes of the other groups) for assign_groups() results."
+    from collections import Counter
+    from grouping import MISC_GROUP_ID
+
+    sizes = Counter(group_of.values())
+    count_misc = sizes.pop(MISC_GROUP_ID, 0) + sizes.pop(None, 0)
+    return count_misc, sizes.values()
+
+
+def format_size_distribution(sizes):
+    "Returns a string of the number of groups in each size range."
+    ranges = []
+    for i, low in enumerate(SIZE_BUCKETS):
+        high = SIZE_BUCKETS[i + 1] - 1 if i + 1 < len(SIZE_BUCKETS) else None
+        count = sum(1 for size in sizes if size >= low and (high is None or size <= high))
+        label = str(low) if low == high else '{}-{}'.format(low, high) if high else '{}+'.format(low)
+        ranges.append('{}: {}'.format(label, count))
+    return ', '.join(ranges)
+
+
+def sweep(signatures, scored_pairs, thresholds):
+    """
+    Groups the people as in step 3 for each threshold. Returns a list of dicts of
+    threshold, groups (not counting misc), misc (people in no group), largest group
+    size, and the list of group sizes.
+    """
+    from grouping import assign_groups
+    from sim_graph import SimGraph
+
+    members = [[person.id for person in people] for people in signatures]
+    names = dict((person.id, (person.first_name, person.last_name))
+                 for people in signatures for person in people)
+    person_ids = sorted(names)
+    results = []
+    for score_threshold in thresholds:
+        graph = SimGraph.from_lists(members, scored_pairs.get_sims(len(signatures), score_threshold))
+        group_of, _ = assign_groups(person_ids, graph.get_similar, names)
+        count_misc, sizes = get_group_sizes(group_of)
+        results.append({
+            'threshold': score_threshold,
+            'groups': len(sizes),
+            'misc': count_misc,
+            'largest': max(sizes) if sizes else 0,
+            'sizes': sizes,
+        })
+    return results
+
+
+def run_sweep(input_file, thresholds, score_floor=SCORE_FLOOR, scores_file=None):
+    """
+    Loads the people from the input file (reusing its database if they were already
+    loaded from the same version of it), scores them once at score_floor (or loads the
+    scores from scores_file, if they were scored from the same version), and prints the
+    groups for each threshold. Returns the results of sweep().
+    """
+    if min(thresholds) < score_floor:
+        raise ValueError('Thresholds must be at least the score floor ({}).'.format(score_floor))
+    scores_file = scores_file or get_scores_file_name(input_file)
+    input_stamp = run_process.get_input_stamp(input_file)
+
+    session = run_process.step_0_create_db(run_process.get_db_name(input_file), resume=True,
+                                           input_file=input_file)
+    run_process.run_stage(session, 'step_1', run_process.step_1_load_people, input_file)
+    # the planner is given the floor, so blocks are only split where no pair above it is lost
+    signatures, plan = run_process.load_signatures(session, score_floor)
+    session.close()
+
+    scored_pairs = None
+    if os.path.exists(scores_file):
+        scored_pairs = ScoredPairs.load(scores_file)
+        if scored_pairs.input_stamp != input_stamp:
+            print '{} was scored from another version of {}; scoring again.'.format(scores_file, input_file)
+            scored_pairs = None
+        elif scored_pairs.score_floor > score_floor:
+            scored_pairs = None     # scored above the floor asked for; score again
+        else:
+            print 'Sim scores loaded from {}.'.format(scores_file)
+    if scored_pairs is None:
+        scored_pairs = score_pairs(signatures, plan, score_floor, input_stamp)
+        scored_pairs.save(scores_file)
+        print '{} pairs scored at or above {} saved to {}.'.format(len(scored_pairs), score_floor, scores_file)
+
+    results = sweep(signatures, scored_pairs, thresholds)
+    print '\nthreshold  groups  grouped  misc  largest  group sizes'
+    for r in results:
+        print '{:>9}  {:>6}  {:>7}  {:>4}  {:>7}  {}'.format(
+            r['threshold'], r['groups'], sum(r['sizes']), r['misc'], r['largest'],
+            format_size_distribution(r['sizes']))
+    return results
+
+
+def parse_args(argv):
+    "Parses command line arguments. Exits with the usage message if they are incorrect."
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare the groups for several score thresholds.',
+                                     usage=USAGE)
+    parser.add_argument('input_file', help='two-column, tab-delimited input file')
+    parser.add_argument('--thresholds', required=True, metavar='T1,T2,...',
+        type=lambda s: sorted(set(int(t) for t in s.split(','))),
+        help='comma-separated score thresholds to group at')
+    parser.add_argument('--score-floor', type=int, default=SCORE_FLOOR, metavar='N',
+        help='keep the scores of pairs scoring at or above N (default {})'.format(SCORE_FLOOR))
+    parser.add_argument('--scores-file', metavar='FILE',
+        help='sidecar file for the scores (default [filename]_scores.bin)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    "Command line entry point. Returns a process exit code."
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    try:
+        run_sweep(args.input_file, args.thresholds, args.score_floor, args.scores_file)
+    except ValueError as e:
+        print e
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())